@@ -5,3 +5,8 @@ from . import data, terminal
 from .__about__ import __doc__
 from .image import Image
 from .grid import Grid
+from .handle import ImageHandle
+from .ids import IdAllocator
+from .index import Index
+from .player import Player
+from .tiled import TiledImage
@@ -3,6 +3,9 @@
 
 """Usage:
   pixcat (-d|--detect-support)
+  pixcat (v|view) [options] FILE...
+  pixcat (i|inspect) [options] LOCATION...
+  pixcat (p|play) [options] LOCATION...
   pixcat [r|resize | t|thumbnail | f|fit-screen] [options] LOCATION...
 
 Display images on a kitty terminal with optional resizing.
@@ -16,11 +19,15 @@ Arguments:
   LOCATION: File, folder to be be scanned recursively for images, or URL.
             Any number of file, folder or URLs can be specified.
 
+  FILE: Path to an image file, possibly very large.
+
 Options:
   Resizing:
     -S, --stretch             Do not force keeping the original aspect ratio.
     -r ALGO, --resample ALGO  From fastest/worse to slowest/best quality:
                               nearest, bilinear, bicubic, lanczos (default).
+    -P, --progressive         Show a fast low quality preview first, then
+                              replace it once the final image is ready.
 
   Specific to r/resize:
     -w INT, --min-width INT   Upscale when width is lower than INT.
@@ -36,6 +43,18 @@ Options:
     -o INT, --horizontal-margin INT  Have a left-right padding of INT columns.
     -v INT, --vertical-margin INT    Have a top-bottom padding of INT columns.
 
+  Specific to p/play, which also uses the f/fit-screen options:
+    --fps FLOAT     Frames to display per second, default 24.
+    --prefetch INT  Frames to decode and resize ahead, default 8.
+    --no-drop       Don't skip frames when decoding can't keep up.
+    --loop          Restart from the first frame after the last one.
+
+  Specific to v/view:
+    --zoom FLOAT  Scale factor, e.g. 0.5 for half size. Default fits the
+                  image in the viewport, which is the terminal or -c/-C size.
+    --pan-x INT   Left side of the viewed region, in pixels of the image.
+    --pan-y INT   Top side of the viewed region, in pixels of the image.
+
   Positioning:
     -x INT, --absolute-x INT  Left image origin in columns, from terminal left.
     -y INT, --absolute-y INT  Top image origin in rows, from terminal top.
@@ -51,6 +70,8 @@ Options:
     -f INT, --offset-x INT    Left offset in pixel, max is column width.
     -F INT, --offset-y INT    Top offset in pixel, max is row height.
 
+    --crop-x INT              Start cropping from INT pixels from the left.
+    --crop-y INT              Start cropping from INT pixels from the top.
     -c INT, --crop-w INT      Crop image left-to-right to INT pixels.
     -C INT, --crop-h INT      Crop image top-to-bottom to INT pixels.
 
@@ -62,11 +83,24 @@ Options:
     -q, --quiet           Keep quiet about errors, e.g. "cannot identify image"
     -R, --raise-errors    Exit and show full traceback if an error happens.
 
+    -I, --index           Remember the files of scanned folders in a database,
+                          so that later runs only open new or modified ones.
+    --sort KEY            With --index, order the images of each folder by
+                          path (default), mtime, size, format, width,
+                          height or pixels.
+    --reverse             With --index, reverse the sort order.
+    --formats LIST        With --index, only show these comma-separated
+                          formats, e.g. jpeg,png.
+
     -g, --hang            Wait for an enter keypress between every image.
     -G, --hang-final      Wait for enter keypress after all images are drawn.
 
     -d, --detect-support  Exit with 0 if terminal supports images, else 1.
 
+    -m NAME, --renderer NAME  How to draw images: kitty, or halfblock,
+                              quadrant and sixel for other terminals (needs
+                              numpy). Default is kitty, halfblock in tmux.
+
 
   Standard:
     --         Mark the end of options, useful if a LOCATION starts by a dash.
@@ -99,18 +133,42 @@ Examples:
   pixcat t -s 128 -r nearest dir1 dir2
     Same as the command above, short form.
 
+  pixcat play --fps 30 --loop 'render/frame_*.png'
+    Play rendered frames as a flipbook, fitted to the terminal.
+    LOCATION can also be a folder, in which case its files are played
+    in name order.
+
+  pixcat inspect screenshot.png
+    Interactively zoom with +/-/0 (fit) and pan with the arrow keys or hjkl,
+    q to quit. The image is only transmitted once, zooming and panning
+    just re-place it with a different source rectangle.
+
+  pixcat --renderer quadrant photo.jpg
+    Draw photo.jpg with colored unicode block characters, for terminals
+    that don't support the kitty graphics protocol.
+
+  pixcat t --index --sort mtime --reverse --formats jpeg /mnt/nas/photos
+    Show thumbnails of JPEG photos, newest first. The first run scans the
+    folder, next ones only check for new or modified files.
+
+  pixcat view --zoom 0.25 --pan-x 40000 --pan-y 12000 scan.tif
+    Display a region of a huge image at a quarter of its size.
+    On first view, a multi-resolution copy of the image is cached on disk,
+    so that later views only need to read the visible region.
+
 Bugs and limitations:
-  - Does not work in tmux
-  - Resizing the terminal can lead to a mess, use clear/CTRL+L to fix it."""
+  - In tmux, images are drawn with text at a much lower resolution
+  - Resizing the terminal can lead to a mess, use clear/CTRL+L to fix it.
+    While waiting with -g/-G, images are redrawn for the new size instead."""
 
 
 import sys
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Sequence
 
 import docopt
 
-from . import Image, data
+from . import Image, Index, Player, TiledImage, data
 from .__about__ import __version__
 from .terminal import TERM
 
@@ -127,31 +185,80 @@ def main(argv: Optional[List[str]] = None) -> None:
         main(["--help"])
         sys.exit(1)
 
+    if params["--renderer"]:
+        TERM.renderer = params["--renderer"]
+
     if params["--detect-support"]:
         sys.exit(0 if TERM.detect_support() else 1)
 
+    if params["v"] or params["view"]:
+        for path in params["FILE"]:
+            TiledImage(path).show(**cli_to_func_params("view", params))
+        return
+
+    if params["p"] or params["play"]:
+        Player.from_locations(
+            *params["LOCATION"],
+            **cli_to_func_params("play", params),
+            fit_screen_params = cli_to_func_params("fit_screen", params),
+            print_errors      = not params["--quiet"]
+        ).play(**cli_to_func_params("show", params))
+        return
+
     images = Image.factory(
         *params["LOCATION"],
         raise_errors = params["--raise-errors"],
-        print_errors = not params["--quiet"]
+        print_errors = not params["--quiet"],
+        index        = Index() if params["--index"] else None,
+        **cli_to_func_params("index", params)
     )
 
+    shown = []
+
     for image in images:
-        handle_image(image, params)
+        if params["i"] or params["inspect"]:
+            image.inspect(align=params["--align"] or "center")
+            continue
+
+        # Originals are kept, so that redraws can resize them again
+        if params["--hang"] or params["--hang-final"]:
+            shown.append(image)
+
+        handle_image(image, params, shown)
 
     if params["--hang-final"]:
-        input("Press enter to exit...")
+        TERM.wait_enter(lambda: redraw(shown, params),
+                        "Press enter to exit...")
+
+
+def redraw(images: List[Image], params: dict) -> None:
+    # After a terminal resize, images are only resized again if their
+    # target size changed. Others are just placed again.
+    TERM.clear_screen()
 
+    for image in images:
+        handle_image(image, params, redrawing=True)
+
+
+def handle_image(image:     Image,
+                 params:    dict,
+                 shown:     Sequence[Image] = (),
+                 redrawing: bool            = False) -> None:
+    method = None
 
-def handle_image(image: Image, params: dict) -> None:
     if params["r"] or params["resize"]:
-        image = image.resize(**cli_to_func_params("resize", params))
+        method = "resize"
 
     elif params["t"] or params["thumbnail"]:
-        image = image.thumbnail(**cli_to_func_params("thumbnail", params))
+        method = "thumbnail"
 
     elif params["f"] or params["fit-screen"]:
-        image = image.fit_screen(**cli_to_func_params("fit_screen", params))
+        method = "fit_screen"
+
+    progressive = method and params["--progressive"] and not redrawing
+
+    if method and not progressive:
+        image = getattr(image, method)(**cli_to_func_params(method, params))
 
     print_align = lambda t: print(TERM.align(t, params["--align"] or "center"))
 
@@ -170,10 +277,17 @@ def handle_image(image: Image, params: dict) -> None:
     if params["--print-id"]:
         print_align(image.id)
 
-    image.show(**cli_to_func_params("show", params))
-
-    if params["--hang"]:
-        input()
+    if progressive:
+        image.show_progressive(
+            method,
+            cli_to_func_params(method, params),
+            **cli_to_func_params("show", params)
+        )
+    else:
+        image.show(**cli_to_func_params("show", params))
+
+    if params["--hang"] and not redrawing:
+        TERM.wait_enter(lambda: redraw(shown, params))
 
 
 def cli_to_func_params(func_name: str, params: dict) -> dict:
@@ -1,10 +1,48 @@
+import os
+from pathlib import Path
+
 ESC = "\033"
 
+CACHE_DIR    = Path(os.environ.get("XDG_CACHE_HOME", "~/.cache"),
+                    "pixcat").expanduser()
+PYRAMIDS_DIR = CACHE_DIR / "pyramids"
+INDEX_FILE   = CACHE_DIR / "index.sqlite3"
+
+# Bytes per pixel for raw decoder modes we know how to split into bands
+RAW_MODE_BYTES = {
+    "L": 1, "P": 1, "LA": 2, "RGB": 3, "RGBA": 4, "RGBX": 4, "CMYK": 4,
+}
+
+# TIFF tags needed to decode a compressed strip or tile on its own
+TIFF_DECODING_TAGS = (
+    258,  # BitsPerSample
+    259,  # Compression
+    262,  # PhotometricInterpretation
+    266,  # FillOrder
+    277,  # SamplesPerPixel
+    284,  # PlanarConfiguration
+    317,  # Predictor
+    320,  # ColorMap
+    338,  # ExtraSamples
+    339,  # SampleFormat
+    347,  # JPEGTables
+    529,  # YCbCrCoefficients
+    530,  # YCbCrSubSampling
+    532,  # ReferenceBlackWhite
+)
+
+# kitty, then text fallbacks for other terminals
+RENDERERS = ("kitty", "halfblock", "quadrant", "sixel")
+
+DEFAULT_CELL_PX_SIZE = (8, 16)  # used when the terminal doesn't tell
+
+CHUNK_SIZE = 4096  # max base64 payload bytes per escape code
+
 MIN_ID = 1
 MAX_ID = 4_294_967_295
 
 # kitty sends a response on stdin (...) for those actions
-ACTIONS_WITH_ANSWER = {"display", "transmit+display", "query"}
+ACTIONS_WITH_ANSWER = {"transmit", "display", "transmit+display", "query"}
 
 IMAGE_CONTROLS = {
     "action": ("a", {
@@ -32,7 +70,8 @@ IMAGE_CONTROLS = {
         "partial": "1",
         "final":   "0"
     }),
-    "id": ("i", {}),
+    "id":           ("i", {}),
+    "placement_id": ("p", {}),  # re-displaying with same one replaces it
 
     # In px, no need to specify if format is png.
     "source_w": ("s", {}),
@@ -68,11 +107,19 @@ IMAGE_CONTROLS = {
     "origin_y":  ("y", {}),
     "z_index":   ("z", {}),
 
+    # In px, source rectangle of the image to display
+    "crop_x": ("x", {}),
+    "crop_y": ("y", {}),
     "crop_w": ("w", {}),
     "crop_h": ("h", {}),
 
     "fit_cols": ("c", {}),
     "fit_rows": ("r", {}),
+
+    "cursor": ("C", {
+        "move": "0",  # move cursor after the displayed image
+        "stay": "1",
+    }),
 }
 
 CLI_TO_FUNCTIONS_PARAMS = {
@@ -105,7 +152,31 @@ CLI_TO_FUNCTIONS_PARAMS = {
         "--align":      ("align",      str),
         "--offset-x":   ("offset_x",   int),
         "--offset-y":   ("offset_y",   int),
+        "--crop-x":     ("crop_x",     int),
+        "--crop-y":     ("crop_y",     int),
         "--crop-w":     ("crop_w",     int),
         "--crop-h":     ("crop_h",     int),
     }
 }
+
+CLI_TO_FUNCTIONS_PARAMS["view"] = {
+    **{k: v for k, v in CLI_TO_FUNCTIONS_PARAMS["show"].items()
+       if k not in ("--crop-x", "--crop-y")},
+    "--zoom":     ("zoom",     float),
+    "--pan-x":    ("pan_x",    int),
+    "--pan-y":    ("pan_y",    int),
+    "--resample": ("resample", str),
+}
+
+CLI_TO_FUNCTIONS_PARAMS["play"] = {
+    "--fps":      ("fps",         float),
+    "--prefetch": ("prefetch",    int),
+    "--no-drop":  ("drop_frames", lambda no_drop: not no_drop),
+    "--loop":     ("loop",        bool),
+}
+
+CLI_TO_FUNCTIONS_PARAMS["index"] = {
+    "--sort":    ("sort",    str),
+    "--reverse": ("reverse", bool),
+    "--formats": ("formats", lambda formats: formats.split(",")),
+}
@@ -0,0 +1,205 @@
+# Copyright 2018 miruka
+# This file is part of pixcat, licensed under LGPLv3.
+
+import importlib
+import io
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+from dataclasses import dataclass, field
+from PIL import Image as PILImage
+
+SourceType = Union[Path, bytes]
+Size       = Optional[Tuple[int, int]]
+
+# Leading bytes of formats that have faster decoders than Pillow
+SIGNATURES = [
+    (0, b"\xff\xd8\xff", "JPEG"),
+    (8, b"WEBP",         "WEBP"),
+]
+
+
+def sniff_format(source: SourceType) -> Optional[str]:
+    if isinstance(source, Path):
+        with open(source, "rb") as file:
+            head = file.read(16)
+    else:
+        head = source[:16]
+
+    for offset, signature, name in SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            return name
+
+    return None
+
+
+@dataclass
+class Decoder:
+    # Decodes a file or bytes to a PIL image. If size is passed, the result
+    # can be smaller than the original but not smaller than size, for
+    # formats that support decoding at a reduced scale.
+    name:    str             = "pillow"
+    formats: Tuple[str, ...] = ()  # empty for any format
+
+    _available: Optional[bool] = field(init=False, repr=False, default=None)
+
+
+    @property
+    def available(self) -> bool:
+        if self._available is None:
+            try:
+                self._load()
+                self._available = True
+            except Exception:  # module or its native library not installed
+                self._available = False
+
+        return self._available
+
+
+    def supports(self, format_name: Optional[str]) -> bool:
+        return not self.formats or format_name in self.formats
+
+
+    def _load(self) -> None:
+        pass
+
+
+    def decode(self, source: SourceType, size: Size = None
+              ) -> PILImage.Image:
+        pil_image = PILImage.open(
+            source if isinstance(source, Path) else io.BytesIO(source)
+        )
+
+        if size:
+            pil_image.draft(pil_image.mode, size)  # JPEG DCT scaling
+
+        pil_image.load()
+        return pil_image
+
+
+@dataclass
+class TurboJPEGDecoder(Decoder):
+    # libjpeg-turbo via PyTurboJPEG, with scaled IDCT for reduced sizes
+    name:    str             = "turbojpeg"
+    formats: Tuple[str, ...] = ("JPEG",)
+
+
+    def _load(self) -> None:
+        from turbojpeg import TurboJPEG
+        self._turbo = TurboJPEG()
+
+
+    def decode(self, source: SourceType, size: Size = None
+              ) -> PILImage.Image:
+        from turbojpeg import TJPF_RGB
+
+        if isinstance(source, Path):
+            source = source.read_bytes()
+
+        width, height, *_ = self._turbo.decode_header(source)
+        factor            = self._scaling_factor(width, height, size)
+
+        pixels = self._turbo.decode(
+            source, pixel_format=TJPF_RGB, scaling_factor=factor
+        )
+        return PILImage.fromarray(pixels, "RGB")
+
+
+    def _scaling_factor(self, width: int, height: int, size: Size
+                       ) -> Optional[Tuple[int, int]]:
+        # The smallest scale that doesn't go below size
+        if not size:
+            return None
+
+        fitting = [
+            (num, den) for num, den in self._turbo.scaling_factors
+            if -(-width * num // den) >= size[0] and
+               -(-height * num // den) >= size[1]
+        ]
+        return min(fitting, key=lambda f: f[0] / f[1], default=None)
+
+
+@dataclass
+class VipsDecoder(Decoder):
+    # libvips via pyvips, which shrinks on load for JPEG and WebP.
+    # Only integer shrinks are done, resampling to the exact size is left
+    # to the caller so that it can pick the resampling filter.
+    name:    str             = "pyvips"
+    formats: Tuple[str, ...] = ("JPEG", "WEBP")
+
+    shrinks: Tuple[int, ...] = (8, 4, 2)
+
+
+    def _load(self) -> None:
+        importlib.import_module("pyvips")
+
+
+    def decode(self, source: SourceType, size: Size = None
+              ) -> PILImage.Image:
+        import pyvips
+
+        def load(**options) -> pyvips.Image:
+            if isinstance(source, Path):
+                return pyvips.Image.new_from_file(
+                    str(source), access="sequential", **options
+                )
+
+            return pyvips.Image.new_from_buffer(
+                source, "", access="sequential", **options
+            )
+
+        vips_image = load()  # pixels are only decoded when needed
+        shrink     = self._shrink_factor(vips_image.width, vips_image.height,
+                                         size)
+
+        if shrink > 1:
+            format_name = sniff_format(source)
+
+            if format_name == "JPEG":
+                vips_image = load(shrink=shrink)
+            elif format_name == "WEBP":
+                vips_image = load(scale=1 / shrink)
+
+        if vips_image.format != "uchar":  # e.g. 16 bits, let Pillow do it
+            raise ValueError(f"Unsupported vips format: {vips_image.format}")
+
+        mode = {1: "L", 2: "LA", 3: "RGB", 4: "RGBA"}[vips_image.bands]
+        return PILImage.frombytes(
+            mode, (vips_image.width, vips_image.height),
+            vips_image.write_to_memory()
+        )
+
+
+    def _shrink_factor(self, width: int, height: int, size: Size) -> int:
+        # The biggest shrink that doesn't go below size
+        if not size:
+            return 1
+
+        fitting = [
+            shrink for shrink in self.shrinks
+            if -(-width // shrink) >= size[0] and
+               -(-height // shrink) >= size[1]
+        ]
+        return max(fitting, default=1)
+
+
+# By order of preference, the first available one supporting a format wins
+DECODERS: List[Decoder] = [TurboJPEGDecoder(), VipsDecoder(), Decoder()]
+
+
+def get_decoders(format_name: Optional[str]) -> List[Decoder]:
+    return [d for d in DECODERS if d.supports(format_name) and d.available]
+
+
+def decode(source: SourceType, size: Size = None) -> PILImage.Image:
+    # If a faster backend fails on some file, e.g. a CMYK JPEG,
+    # try the next ones, Pillow being last.
+    *faster, pillow = get_decoders(sniff_format(source))
+
+    for decoder in faster:
+        try:
+            return decoder.decode(source, size)
+        except Exception:
+            pass
+
+    return pillow.decode(source, size)
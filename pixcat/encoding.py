@@ -0,0 +1,167 @@
+# Copyright 2018 miruka
+# This file is part of pixcat, licensed under LGPLv3.
+
+import io
+import zlib
+from typing import Optional, Tuple, Union
+
+from dataclasses import dataclass
+from PIL import Image as PILImage
+
+BUFFER_MODES = {1: "L", 3: "RGB", 4: "RGBA"}  # by bytes per pixel
+
+
+@dataclass
+class PixelBuffer:
+    # Raw 8-bit pixels in row-major order, shared with the object they come
+    # from: changing that object's content also changes this one's.
+    data:   memoryview  # flat, one byte per item
+    width:  int
+    height: int
+    mode:   str         # L, RGB or RGBA
+
+
+    def __post_init__(self) -> None:
+        assert self.mode in BUFFER_MODES.values(), self.mode
+
+        bands = len(self.mode)
+        if len(self.data) != self.width * self.height * bands:
+            raise ValueError(
+                f"Buffer has {len(self.data)} bytes, expected "
+                f"{self.width}x{self.height}x{bands}"
+            )
+
+
+    @classmethod
+    def from_buffer(cls, buffer, size: Tuple[int, int], mode: str = "RGB"
+                   ) -> "PixelBuffer":
+        # Any object supporting the buffer protocol, e.g. bytearray or mmap
+        return cls(_flat_view(memoryview(buffer)), *size, mode)
+
+
+    @classmethod
+    def from_array(cls, array) -> "PixelBuffer":
+        # A (height, width) or (height, width, 3 or 4) uint8 array, e.g. from
+        # NumPy, or a memoryview with that shape.
+        view = memoryview(array)
+
+        if view.format not in ("B", "<B", "=B", "|B") or \
+           view.ndim not in (2, 3):
+            raise TypeError(
+                f"Expected a 2D or 3D array of uint8, got {view.ndim}D array "
+                f"of format {view.format!r}"
+            )
+
+        bands = view.shape[2] if view.ndim == 3 else 1
+
+        if bands not in BUFFER_MODES:
+            raise ValueError(f"Unsupported number of channels: {bands}")
+
+        height, width = view.shape[:2]
+        return cls(_flat_view(view), width, height, BUFFER_MODES[bands])
+
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return (self.width, self.height)
+
+
+    def to_pil(self) -> PILImage.Image:
+        # Pillow shares the memory for L and RGBA, RGB needs to be unpacked
+        return PILImage.frombuffer(
+            self.mode, self.size, self.data, "raw", self.mode, 0, 1
+        )
+
+
+def _flat_view(view: memoryview) -> memoryview:
+    if not view.c_contiguous:
+        view = memoryview(view.tobytes())  # e.g. a slice, must be copied
+
+    return view.cast("B")
+
+
+@dataclass
+class EncodingPlan:
+    format:   str            # rgb, rgba or png
+    medium:   str            # tempfile or direct
+    level:    int = 0        # zlib or png compression level
+    compress: Optional[str] = None  # zlib for compressed rgb/rgba
+
+
+    @property
+    def mode(self) -> str:
+        return {"rgb": "RGB", "rgba": "RGBA"}.get(self.format, "")
+
+
+def has_alpha(pil_image: PILImage.Image) -> bool:
+    # Whether the image has an alpha channel that's actually used,
+    # i.e. not fully opaque.
+    if pil_image.mode == "P" and "transparency" in pil_image.info:
+        pil_image = pil_image.convert("RGBA")
+
+    if "A" not in pil_image.getbands():
+        return False
+
+    return pil_image.getchannel("A").getextrema()[0] < 255
+
+
+def compression_level(raw_size: int) -> int:
+    # Past a few MB, zlib's time dominates what less bytes save on a pty
+    if raw_size < 1024 ** 2:
+        return 6
+
+    if raw_size < 8 * 1024 ** 2:
+        return 3
+
+    return 1
+
+
+def plan_encoding(pil_image: Union[PILImage.Image, PixelBuffer], medium: str
+                 ) -> EncodingPlan:
+
+    if isinstance(pil_image, PixelBuffer):
+        # Trust the declared mode, scanning the alpha values costs a copy
+        alpha = pil_image.mode == "RGBA"
+    else:
+        alpha = has_alpha(pil_image)
+
+    # Local files: kitty reads raw pixels from the disk cache quickly,
+    # any compression would only be wasted CPU time.
+    if medium != "direct":
+        return EncodingPlan("rgba" if alpha else "rgb", medium)
+
+    bands    = 4 if alpha else 3
+    raw_size = pil_image.width * pil_image.height * bands
+    level    = compression_level(raw_size)
+
+    # In-band data goes through the pty in base64: compress.
+    # PNG keeps palettes and 1-bit images compact, zlib on raw pixels is
+    # faster for everything else.
+    if pil_image.mode in ("1", "P"):
+        return EncodingPlan("png", medium, level)
+
+    return EncodingPlan("rgba" if alpha else "rgb", medium, level, "zlib")
+
+
+def encode(pil_image: Union[PILImage.Image, PixelBuffer], plan: EncodingPlan
+          ) -> Union[bytes, memoryview]:
+
+    if isinstance(pil_image, PixelBuffer):
+        if pil_image.mode == plan.mode:
+            # No copy when sent without compression, since the memory
+            # can directly be written to a file or base64-encoded.
+            raw = pil_image.data
+            return zlib.compress(raw, plan.level) if plan.compress else raw
+
+        pil_image = pil_image.to_pil()
+
+    if plan.format == "png":
+        out = io.BytesIO()
+        pil_image.save(out, format="PNG", compress_level=plan.level)
+        return out.getvalue()
+
+    if pil_image.mode != plan.mode:
+        pil_image = pil_image.convert(plan.mode)
+
+    raw = pil_image.tobytes()
+    return zlib.compress(raw, plan.level) if plan.compress else raw
@@ -0,0 +1,144 @@
+# Copyright 2018 miruka
+# This file is part of pixcat, licensed under LGPLv3.
+
+# Render images as text for terminals without the kitty graphics protocol.
+# Pixels are converted with vectorized NumPy operations, and escape codes are
+# only emitted where colors change along a row, not for every cell.
+
+from typing import List
+
+from PIL import Image as PILImage
+
+from . import data
+
+# Indexed by which quarters are foreground: 1 top-left, 2 top-right,
+# 4 bottom-left, 8 bottom-right.
+QUADRANTS = " ▘▝▀▖▌▞▛▗▚▐▜▄▙▟█"
+
+
+def _to_rgb(pil_image: PILImage.Image) -> PILImage.Image:
+    # Transparent parts are drawn over black
+    if "A" in pil_image.getbands() or "transparency" in pil_image.info:
+        pil_image = pil_image.convert("RGBA")
+        black     = PILImage.new("RGBA", pil_image.size, (0, 0, 0, 255))
+        return PILImage.alpha_composite(black, pil_image).convert("RGB")
+
+    return pil_image.convert("RGB")
+
+
+def _colored_rows(glyphs, fg, bg) -> List[str]:
+    # glyphs: (rows, cols) str, fg/bg: (rows, cols, 3) uint8
+    import numpy as np
+
+    colors  = np.concatenate((fg, bg), axis=2)
+    changed = np.any(colors[:, 1:] != colors[:, :-1], axis=2)
+    lines   = []
+
+    for y in range(glyphs.shape[0]):
+        starts = np.flatnonzero(np.concatenate(([True], changed[y])))
+        ends   = np.append(starts[1:], glyphs.shape[1])
+        parts  = []
+
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            r, g, b, r2, g2, b2 = colors[y, start].tolist()
+            parts.append(
+                f"{data.ESC}[38;2;{r};{g};{b};48;2;{r2};{g2};{b2}m"
+                f"{''.join(glyphs[y, start:end].tolist())}"
+            )
+
+        lines.append("".join(parts) + f"{data.ESC}[0m")
+
+    return lines
+
+
+def halfblock(pil_image: PILImage.Image, cols: int, rows: int) -> List[str]:
+    # Each cell shows two pixels: the upper one as the foreground of "▀",
+    # the lower one as the background.
+    import numpy as np
+
+    pixels = np.asarray(
+        _to_rgb(pil_image).resize((cols, rows * 2), PILImage.BILINEAR)
+    )
+    glyphs = np.full((rows, cols), "▀")
+    return _colored_rows(glyphs, pixels[0::2], pixels[1::2])
+
+
+def quadrant(pil_image: PILImage.Image, cols: int, rows: int) -> List[str]:
+    # Each cell shows 2x2 pixels, split in two colors: pixels brighter than
+    # the cell's average become the foreground, others the background.
+    import numpy as np
+
+    pixels = np.asarray(
+        _to_rgb(pil_image).resize((cols * 2, rows * 2), PILImage.BILINEAR)
+    ).astype(np.float32)
+
+    # (rows, cols, 4 quarters, 3 channels), quarters in QUADRANTS bit order
+    blocks = pixels.reshape(rows, 2, cols, 2, 3) \
+                   .transpose(0, 2, 1, 3, 4) \
+                   .reshape(rows, cols, 4, 3)
+
+    luma  = blocks @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    is_fg = luma > luma.mean(axis=2, keepdims=True)
+
+    fg_count = is_fg.sum(axis=2, keepdims=True)
+    bg_count = 4 - fg_count
+    fg_sum   = (blocks * is_fg[..., None]).sum(axis=2)
+    bg_sum   = blocks.sum(axis=2) - fg_sum
+
+    # Uniform cells have no foreground, use their average for both colors
+    fg = np.where(fg_count > 0, fg_sum / np.maximum(fg_count, 1),
+                  bg_sum / 4)
+    bg = np.where(bg_count > 0, bg_sum / np.maximum(bg_count, 1), fg)
+
+    index  = is_fg @ np.array([1, 2, 4, 8])
+    glyphs = np.array(list(QUADRANTS))[index]
+
+    return _colored_rows(
+        glyphs, fg.round().astype(np.uint8), bg.round().astype(np.uint8)
+    )
+
+
+def sixel(pil_image: PILImage.Image, colors: int = 256) -> str:
+    import numpy as np
+
+    quantized = _to_rgb(pil_image).quantize(colors, method=2)  # fast octree
+    indexes   = np.asarray(quantized)
+    palette   = quantized.getpalette()[:(int(indexes.max()) + 1) * 3]
+    height, width = indexes.shape
+
+    out = [f"{data.ESC}Pq\"1;1;{width};{height}"]
+
+    for i in range(len(palette) // 3):
+        r, g, b = (round(c * 100 / 255) for c in palette[i * 3:i * 3 + 3])
+        out.append(f"#{i};2;{r};{g};{b}")
+
+    shifts = np.arange(6, dtype=np.uint8)[:, None]
+
+    for top in range(0, height, 6):
+        band  = indexes[top:top + 6]
+        lines = []
+
+        for color in np.unique(band).tolist():
+            # Bit n of each column's sixel is set if row n has this color
+            bits = ((band == color).astype(np.uint8) <<
+                    shifts[:len(band)]).sum(axis=0)
+
+            used = np.flatnonzero(bits)
+            bits = bits[:used[-1] + 1]  # trailing blanks are implicit
+
+            starts = np.flatnonzero(np.concatenate(([True],
+                                                    bits[1:] != bits[:-1])))
+            ends   = np.append(starts[1:], len(bits))
+            runs   = []
+
+            for start, end, value in zip(starts.tolist(), ends.tolist(),
+                                         bits[starts].tolist()):
+                char = chr(63 + value)
+                runs.append(f"!{end - start}{char}" if end - start > 3 else
+                            char * (end - start))
+
+            lines.append(f"#{color}{''.join(runs)}")
+
+        out.append("$".join(lines) + "-")
+
+    return "".join(out) + f"{data.ESC}\\"
@@ -3,17 +3,114 @@
 
 import math
 import textwrap
-from typing import AnyStr, Callable, Iterable, Optional, Union
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import (
+    AnyStr, Callable, Dict, Iterable, List, Optional, Tuple, Union
+)
 
 import ansiwrap
 from ansiwrap import ansilen
 from dataclasses import dataclass, field
+from PIL import Image as PILImage
+from PIL import ImageDraw
 
 from . import Image
-from .terminal import TERM
+from .handle import ImageHandle
+from .image import _draw_in_executor, _in_executor
+from .index import Index
+from .terminal import TERM, KittyAnswerError
 
-FromCallable = Union[None, Image, AnyStr]
-CellType     = Union[None, Image, AnyStr, Callable[["Grid"], FromCallable]]
+FromCallable = Union[None, Image, ImageHandle, AnyStr]
+CellType     = Union[
+    None, Image, ImageHandle, AnyStr, Callable[["Grid"], FromCallable]
+]
+
+
+class CellImage:
+    # A cell's resized image. Its pixels are only kept until it's shown,
+    # then just what's needed to place it again, kitty keeping the data.
+
+    __slots__ = ("image", "id", "cols", "rows", "_transmitted", "_content")
+
+    def __init__(self, image: Image) -> None:
+        self.image           = image
+        self.id              = image.id
+        self.cols, self.rows = image.cols, image.rows
+        self._transmitted    = False
+        self._content        = None
+
+
+    @property
+    def transmitted(self) -> bool:
+        if self._content:  # deduplicated, may have been hidden by others
+            return self._content.transmitted
+
+        return self._transmitted
+
+
+    def forget_pixels(self) -> None:
+        image, self.image = self.image, None
+
+        if image:
+            self.id           = image.id
+            self._transmitted = image._transmitted
+            self._content     = image._content  # keeps a shared id in use
+
+
+@dataclass
+class Placement:
+    index: int  # position of the cell in Grid.cells
+    sheet: Image
+
+    # Position and size of the content in pixels, relative to the sheet
+    x: int
+    y: int
+    w: int
+    h: int
+
+    # Position and size of the cell in columns/rows, relative to the grid
+    col:  int
+    row:  int
+    cols: int
+    rows: int
+
+    def contains(self, col: int, row: int) -> bool:
+        return self.col <= col < self.col + self.cols and \
+               self.row <= row < self.row + self.rows
+
+
+@dataclass
+class CellLayout:
+    index:   int                    # position of the cell in Grid.cells
+    content: Union[CellImage, str]
+
+    # Position of the cell in columns/rows, relative to the grid
+    col: int
+    row: int
+
+    # Padding to center the content inside the cell, and content size
+    inner_x: int
+    inner_y: int
+    cols:    int
+    rows:    int
+
+
+@dataclass
+class GridLayout:
+    cells_per_row: int
+    cell_cols:     int
+    cell_rows:     int
+    rows:          List[List[CellLayout]]
+
+
+@dataclass
+class Sheet:
+    image:      Image
+    rows:       int                         # height in terminal rows
+    texts:      List[Tuple[int, int, str]]  # (col, row, text) to print on it
+    placements: List[Placement]
 
 
 @dataclass
@@ -31,6 +128,53 @@ class Grid:
     raise_errors: bool = False
     print_errors: bool = True
 
+    workers: Optional[int] = None  # for parallel thumbnail resizing
+
+    # Transmit identical thumbnails only once, and resize images coming
+    # from the same file or URL only once.
+    deduplicate: bool = False
+
+    # Paste all thumbnails on one big image per screenful and transmit that,
+    # instead of transmitting and placing every cell separately.
+    composite:      bool = False
+    composite_text: bool = False  # also draw text cells on the composite
+
+    placements: List[Placement] = \
+        field(init=False, repr=False, compare=False, default_factory=list)
+
+    # Resolved and measured cell contents, and layouts,
+    # both keyed by (cells per row, cell cols, cell rows).
+    _contents_cache: Dict[Tuple[int, int, int], List[tuple]] = \
+        field(init=False, repr=False, compare=False, default_factory=dict)
+
+    _layouts_cache: Dict[Tuple[int, int, int], GridLayout] = \
+        field(init=False, repr=False, compare=False, default_factory=dict)
+
+    # Composite sheets of the last layout shown, keyed by the layout key
+    # and rows per sheet. Kept to place them again, replaced ones are
+    # deleted from the terminal.
+    _sheets_cache: Dict[Tuple[int, int, int, int], List[Sheet]] = \
+        field(init=False, repr=False, compare=False, default_factory=dict)
+
+
+    @classmethod
+    def from_index(cls,
+                   index:      Index,
+                   *locations: Union[str, Path],
+                   sort:       str                     = "path",
+                   reverse:    bool                    = False,
+                   formats:    Optional[Iterable[str]] = None,
+                   **kwargs) -> "Grid":
+
+        # One image cell per indexed image under locations, which are
+        # scanned for changes first. Other files are skipped without
+        # being opened, and known dimensions are reused.
+        index.scan(*locations)
+        entries = index.entries(*locations, sort=sort, reverse=reverse,
+                                formats=formats)
+
+        return cls([ImageHandle.from_entry(e) for e in entries], **kwargs)
+
 
     @property
     def cell_cols(self) -> int:
@@ -48,69 +192,317 @@ class Grid:
         return max(1, math.floor(TERM.width / self.cell_cols))
 
 
+    def layout(self) -> GridLayout:
+        cell_cols, cell_rows = self.cell_cols, self.cell_rows
+        cells_per_row        = self.cells_per_row
+
+        key    = (cells_per_row, cell_cols, cell_rows)
+        cached = self._layouts_cache.get(key)
+        if cached:
+            return cached
+
+        contents = self._get_measured_contents(*key)
+        rows     = []
+
+        for index, (content, content_cols, content_rows) in \
+                enumerate(contents):
+
+            row_index, col_index = divmod(index, cells_per_row)
+
+            if self.max_rows and row_index >= self.max_rows:
+                break
+
+            if col_index == 0:
+                rows.append([])
+
+            rows[-1].append(CellLayout(
+                index   = index,
+                content = content,
+                col     = col_index * cell_cols,
+                row     = row_index * cell_rows,
+                inner_x = round((cell_cols / 2) - (content_cols / 2)),
+                inner_y = math.floor((cell_rows / 2) - (content_rows / 2)),
+                cols    = content_cols,
+                rows    = content_rows,
+            ))
+
+        layout = GridLayout(cells_per_row, cell_cols, cell_rows, rows)
+        self._layouts_cache[key] = layout
+        return layout
+
+
+    def clear_layout_cache(self) -> "Grid":
+        # Sheets showing the old contents are deleted from the terminal
+        self._contents_cache = {}
+        self._layouts_cache  = {}
+        self._release_sheets()
+        return self
+
+
+    def _release_sheets(self) -> None:
+        for sheets in self._sheets_cache.values():
+            for sheet in sheets:
+                sheet.image.release()
+
+        self._sheets_cache = {}
+
+
+    def _get_measured_contents(self,
+                               cells_per_row: int,
+                               cell_cols:     int,
+                               cell_rows:     int) -> List[tuple]:
+
+        key    = (cells_per_row, cell_cols, cell_rows)
+        cached = self._contents_cache.get(key)
+        if cached:
+            return cached
+
+        # Materialize once, so that generators can be laid out again later
+        self.cells = cells = list(self.cells)
+
+        # Don't resize images in cells that won't be shown
+        if self.max_rows:
+            cells = cells[:self.max_rows * cells_per_row]
+
+        # Handles only weakly keep their resized image, hold them until the
+        # contents are cached.
+        prefetched = self._prefetch_resized_images(cells)
+
+        contents = []
+        for cell in cells:
+            content = self._get_content(cell)
+
+            if isinstance(content, Image):
+                content = CellImage(content)
+
+            contents.append((content, *self._get_content_size(content)))
+
+        del prefetched
+
+        self._contents_cache[key] = contents
+        return contents
+
+
     def show(self) -> "Grid":
+        layout = self.layout()
+
+        if self.composite:
+            return self._show_composite(layout)
+
         # We have to handle y/rows manually because of forced blank lines,
         # terminal scrolling, etc; but x/columns are no trouble.
-        start_x = x = TERM.get_location()[1]
+        start_x   = TERM.get_location()[1]
+        cell_rows = layout.cell_rows
 
-        printed_rows = 0
+        for row_index, row in enumerate(layout.rows):
 
-        for index, cell in enumerate(self.cells):
+            if row_index > 0 or layout.cells_per_row < 2:
+                # Print enough lines to begin a new row below the previous one
+                TERM.print_esc("\n" * cell_rows)
 
-            last_in_row   = index % self.cells_per_row == 0
-            one_per_row   = self.cells_per_row < 2
-            first_in_row  = index == 0
+            for cell in row:
+                x = start_x + cell.col + cell.inner_x
 
-            if last_in_row and (one_per_row or not first_in_row):
-                # Print enough lines to begin a new row below the previous one
-                TERM.print_esc("\n" * self.cell_rows)
+                # Print the vertical padding as blank lines
+                TERM.print_esc("\n" * cell.inner_y)
 
-                printed_rows += 1
+                if isinstance(cell.content, CellImage):
+                    self._show_cell_image(cell, x)
+                else:
+                    print(textwrap.indent(cell.content, " " * x))
 
-                if self.max_rows and printed_rows > self.max_rows:
-                    break
+                # If needed, print blank lines to "complete the cell",
+                # i.e. content height didn't fill it.
+                # The cursor needs to always be at the cell row's bottom,
+                # for the next "put back" escape code to work properly.
+                TERM.print_esc("\n" * (cell_rows - cell.rows - cell.inner_y))
 
-                x = start_x
+                # "Undo" any terminal scrolling and put cursor back to the row
+                # beginning so we can print more content in line.
+                TERM.print_esc(TERM.move_relative_y(-cell_rows - 1))
 
-            content: FromCallable = self._get_content(cell)
+        TERM.print_esc("\n" * cell_rows)
+        return self
 
-            if isinstance(content, Image):
-                content_cols = content.cols
-                content_rows = content.rows
-            elif not content:
-                content_cols = content_rows = 0
-            else:
-                content_cols = ansilen(max(content.splitlines(), key=ansilen))
-                content_rows = ansilen(content.splitlines())
 
-            # Calculate paddings inside the cell to align the content
-            inner_x = round((self.cell_cols / 2) - (content_cols / 2))
-            inner_y = math.floor((self.cell_rows / 2) - (content_rows / 2))
+    def _show_cell_image(self, cell: CellLayout, x: int) -> None:
+        cell_image = cell.content
 
-            # Print the vertical padding as blank lines
-            TERM.print_esc("\n" * inner_y)
+        if not cell_image.image and cell_image.transmitted:
+            try:
+                TERM.print_esc(TERM.move_x(x))
+                TERM.run_code(action="display", id=cell_image.id, z_index=-1)
+                return
+            except KittyAnswerError:
+                pass  # kitty may have evicted the image data
 
-            if isinstance(content, Image):
-                content.show(x = x + inner_x, z=-1)
-            else:
-                print(textwrap.indent(content, " " * (x + inner_x)))
+        image = cell_image.image or self._get_cell_pixels(cell)
+
+        if image:
+            image.deduplicate = self.deduplicate
+            image.show(x=x, z=-1)
+            cell_image.image = image
+            cell_image.forget_pixels()
 
-            # If needed, print blank lines to "complete the cell",
-            # i.e. content height didn't fill it.
-            # The cursor needs to always be at the cell row's bottom,
-            # for the next "put back" escape code to work properly.
-            TERM.print_esc("\n" * (self.cell_rows - content_rows - inner_y))
 
-            # "Undo" any terminal scrolling and put cursor back to the row
-            # beginning so we can print more content in line.
-            TERM.print_esc(TERM.move_relative_y(-self.cell_rows - 1))
+    def _get_cell_pixels(self, cell: CellLayout) -> Optional[Image]:
+        # Resize a cell's image again after its pixels were forgotten
+        if cell.content.image:
+            return cell.content.image
 
-            x += self.cell_cols
+        content = self._get_content(self.cells[cell.index])
+        return content if isinstance(content, Image) else None
+
+
+    def redraw(self) -> "Grid":
+        # After a terminal resize: clear the screen and lay the grid out
+        # for the new width. Resized images are reused, and images that
+        # were already transmitted are only placed again.
+        TERM.clear_screen()
+        return self.show()
+
+
+    async def ashow(self) -> "Grid":
+        # Decoding, resizing and measuring happen in an executor.
+        # Drawing is done in a thread too, since it's a long sequence of
+        # blocking cursor moves and placements that must not be interleaved
+        # with other output, hence the terminal lock.
+        await _in_executor(self.layout)
+
+        async with TERM.async_lock:
+            await _draw_in_executor(self.show)
 
-        TERM.print_esc("\n" * self.cell_rows)
         return self
 
 
+    def _show_composite(self, layout: GridLayout) -> "Grid":
+        start_x = TERM.get_location()[1]
+
+        # Each sheet must fit on screen, since we can't scroll while drawing
+        rows_per_sheet  = max(1, (TERM.height - 1) // layout.cell_rows)
+        self.placements = []
+
+        key = (layout.cells_per_row, layout.cell_cols, layout.cell_rows,
+               rows_per_sheet)
+
+        if key not in self._sheets_cache:
+            self._release_sheets()
+            self._sheets_cache[key] = []
+
+        sheets = self._sheets_cache[key]
+
+        # Sheets are made as they're shown, already made ones only need
+        # to be placed again.
+        for index, first_row in \
+                enumerate(range(0, len(layout.rows), rows_per_sheet)):
+
+            if index == len(sheets):
+                sheets.append(self._make_sheet(
+                    layout, layout.rows[first_row:first_row + rows_per_sheet]
+                ))
+
+            self._show_sheet(sheets[index], start_x)
+
+        return self
+
+
+    def _make_sheet(self, layout: GridLayout, rows: List[List[CellLayout]]
+                   ) -> Sheet:
+
+        cell_px_w, cell_px_h = TERM.cell_px_size
+        cell_cols, cell_rows = layout.cell_cols, layout.cell_rows
+        first_row            = rows[0][0].row
+        sheet_cols           = cell_cols * max(len(row) for row in rows)
+        sheet_rows           = cell_rows * len(rows)
+
+        canvas = PILImage.new(
+            "RGBA", (sheet_cols * cell_px_w, sheet_rows * cell_px_h)
+        )
+        sheet      = Image(canvas)
+        draw       = ImageDraw.Draw(canvas) if self.composite_text else None
+        texts      = []
+        placements = []
+
+        for cell in (cell for row in rows for cell in row):
+            content = cell.content
+            col     = cell.col
+            row     = cell.row - first_row
+
+            if isinstance(content, CellImage):
+                image = self._get_cell_pixels(cell)
+                content.forget_pixels()
+
+                if not image:
+                    continue
+
+                w, h = image.size
+                x    = col * cell_px_w + (cell_cols * cell_px_w - w) // 2
+                y    = row * cell_px_h + (cell_rows * cell_px_h - h) // 2
+
+                canvas.paste(image._pil_image, (x, y))
+
+                placements.append(Placement(
+                    index = cell.index,
+                    sheet = sheet,
+                    x = x, y = y, w = w, h = h,
+                    col  = cell.col,
+                    row  = cell.row,
+                    cols = cell_cols,
+                    rows = cell_rows,
+                ))
+
+            elif content and draw:
+                for i, line in enumerate(content.splitlines()):
+                    draw.text(
+                        ((col + cell.inner_x) * cell_px_w,
+                         (row + cell.inner_y + i) * cell_px_h),
+                        ansiwrap.strip_color(line),
+                        fill = "white"
+                    )
+
+            elif content:
+                texts.append((col + cell.inner_x, row + cell.inner_y, content))
+
+        return Sheet(sheet, sheet_rows, texts, placements)
+
+
+    def _show_sheet(self, sheet: Sheet, start_x: int) -> None:
+        # Reserve space for the sheet first, so that the terminal doesn't
+        # scroll after we computed where the sheet's top is.
+        TERM.print_esc("\n" * sheet.rows)
+        top = TERM.get_location()[0] - sheet.rows
+
+        sheet.image.show(x=start_x, y=top, z=-1)
+
+        for col, row, text in sheet.texts:
+            for i, line in enumerate(text.splitlines()):
+                TERM.print_esc(TERM.move(top + row + i, start_x + col), line)
+
+        TERM.print_esc(TERM.move(top + sheet.rows, 0))
+        self.placements += sheet.placements
+
+
+    def placement_at(self, col: int, row: int) -> Optional[Placement]:
+        # col and row are relative to the grid's top-left corner
+        for placement in self.placements:
+            if placement.contains(col, row):
+                return placement
+
+        return None
+
+
+    @staticmethod
+    def _get_content_size(content: Union[CellImage, str]) -> Tuple[int, int]:
+        if isinstance(content, CellImage):
+            return (content.cols, content.rows)
+
+        if not content:
+            return (0, 0)
+
+        lines = content.splitlines()
+        return (max(map(ansilen, lines)), len(lines))
+
+
     def _get_content(self, cell: CellType) -> Union[Image, str]:
         if cell is None:
             return ""
@@ -118,13 +510,56 @@ class Grid:
         if isinstance(cell, Callable):
             return self._get_content(cell(self))
 
-        if isinstance(cell, Image):
+        if isinstance(cell, (Image, ImageHandle)):
             return self._get_resized_image(cell)
 
         return self._get_text(cell)
 
 
-    def _get_resized_image(self, image: Image) -> Image:
+    def _prefetch_resized_images(self, cells: List[CellType]
+                                ) -> List[Optional[Image]]:
+        # Resize all the images in bulk and in parallel, results are kept in
+        # their _resized_cache and picked up by _get_resized_image().
+        # Errors are ignored here, they'll be handled when showing each cell.
+        images  = [cell for cell in cells if isinstance(cell, Image)]
+        handles = [cell for cell in cells if isinstance(cell, ImageHandle)]
+        sharing = []  # [(image, image with the same origin to share with)]
+
+        if self.deduplicate:
+            by_origin = {}
+
+            for image in images:
+                if isinstance(image.origin, (str, Path)):
+                    first = by_origin.setdefault(str(image.origin), image)
+                    if first is not image:
+                        sharing.append((image, first))
+
+        shared_ids = {id(image) for image, _ in sharing}
+
+        resized = Image.resize_many(
+            [image for image in images if id(image) not in shared_ids],
+            1, 1, self.cell_w, self.cell_h,
+            workers      = self.workers,
+            raise_errors = False
+        )
+
+        for image, first in sharing:
+            image._resized_cache.update(first._resized_cache)
+
+        def resize_handle(handle: ImageHandle) -> Optional[Image]:
+            try:
+                return handle.resize(1, 1, self.cell_w, self.cell_h)
+            except Exception:
+                return None
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            resized += pool.map(resize_handle, handles)
+
+        return resized
+
+
+    def _get_resized_image(self, image: Union[Image, ImageHandle]
+                          ) -> Image:
         try:
             return image.resize(1, 1, self.cell_w, self.cell_h)
 
@@ -139,17 +574,30 @@ class Grid:
     def _get_text(self, text: AnyStr) -> str:
         assert self.text_overflow in ("wrap", "shorten")
 
-        lines = getattr(ansiwrap, self.text_overflow)(
-            str(text),
-            width              = self.cell_cols,
-            placeholder        = self.cut_placeholder,
-            tabsize            = 4,
-            replace_whitespace = False,
-            drop_whitespace    = False
+        return _wrap_text(
+            str(text), self.cell_cols, self.cell_rows,
+            self.text_overflow, self.cut_placeholder
         )
 
-        if isinstance(lines, str):  # shorten returns a str, wrap a list
-            return lines
 
-        lines = [l for line in lines for l in line.splitlines()]
-        return "\n".join(lines[:self.cell_rows])
+@lru_cache(maxsize=4096)
+def _wrap_text(text:        str,
+               cols:        int,
+               rows:        int,
+               overflow:    str,
+               placeholder: str) -> str:
+
+    lines = getattr(ansiwrap, overflow)(
+        text,
+        width              = cols,
+        placeholder        = placeholder,
+        tabsize            = 4,
+        replace_whitespace = False,
+        drop_whitespace    = False
+    )
+
+    if isinstance(lines, str):  # shorten returns a str, wrap a list
+        return lines
+
+    lines = [l for line in lines for l in line.splitlines()]
+    return "\n".join(lines[:rows])
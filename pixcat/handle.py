@@ -0,0 +1,97 @@
+# Copyright 2018 miruka
+# This file is part of pixcat, licensed under LGPLv3.
+
+import weakref
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+from PIL import Image as PILImage
+
+from . import decoders
+from .image import Image, _get_resize_size
+from .index import Entry
+
+
+class ImageHandle:
+    # A lightweight reference to an image file for catalogue-scale use,
+    # e.g. 100k cells in a Grid: no file stays open, dimensions are read
+    # on demand, and the last resized image is only weakly referenced,
+    # so that memory goes to what's being displayed.
+
+    __slots__ = ("path", "_size", "_resized_key", "_resized_ref")
+
+    def __init__(self,
+                 path: Union[str, Path],
+                 size: Optional[Tuple[int, int]] = None) -> None:
+
+        self.path         = Path(path).expanduser()
+        self._size        = size
+        self._resized_key = None
+        self._resized_ref = None
+
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({str(self.path)!r})"
+
+
+    @classmethod
+    def from_entry(cls, entry: Entry) -> "ImageHandle":
+        size = (entry.width, entry.height) if entry.is_image else None
+        return cls(entry.path, size)
+
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        if self._size is None:
+            with PILImage.open(self.path) as pil_image:  # header only
+                self._size = pil_image.size
+
+        return self._size
+
+
+    def open(self) -> Image:
+        return Image(self.path)
+
+
+    def resize(self,
+               min_w:        int             = 1,
+               min_h:        int             = 1,
+               max_w:        Optional[int]   = None,
+               max_h:        Optional[int]   = None,
+               stretch:      bool            = False,
+               resample:     str             = "lanczos",
+               reducing_gap: Optional[float] = 2.0) -> Image:
+
+        size = _get_resize_size(self.size, min_w, min_h, max_w, max_h,
+                                stretch)
+        key  = (size, resample)
+
+        if self._resized_key == key:
+            cached = self._resized_ref()
+            if cached:
+                return cached
+
+        # Decode directly at a reduced scale when the format allows it,
+        # the full size image is never kept.
+        pil_image = decoders.decode(self.path, size)
+
+        if pil_image.size != size:
+            pil_image = pil_image.resize(
+                size, getattr(PILImage, resample.upper()),
+                reducing_gap=reducing_gap
+            )
+
+        image        = Image(pil_image)
+        image.origin = self.path
+
+        self._resized_key = key
+        self._resized_ref = weakref.ref(image)
+        return image
+
+
+    def thumbnail(self,
+                  size:     int  = 256,
+                  stretch:  bool = False,
+                  resample: str  = "lanczos") -> Image:
+
+        return self.resize(size, size, size, size, stretch, resample)
@@ -0,0 +1,114 @@
+# Copyright 2018 miruka
+# This file is part of pixcat, licensed under LGPLv3.
+
+import os
+import random
+import threading
+import weakref
+from typing import Any, List, Optional, Set
+
+from . import data
+
+
+class IdAllocator:
+    # Hands out kitty image ids sequentially from a random start, so that
+    # processes drawing on the same terminal are unlikely to collide.
+    # Only ids in use are remembered. Released ids are reused first,
+    # forgotten ones only once the whole sequence wrapped around.
+    # Ids can have an owner object, they're forgotten when it's
+    # garbage-collected.
+
+    def __init__(self, min_id: int = data.MIN_ID, max_id: int = data.MAX_ID
+                ) -> None:
+        self.min_id = min_id
+        self.max_id = max_id
+
+        self._lock            = threading.Lock()
+        self._next            = min_id
+        self._live: Set[int]  = set()  # without an owner
+        self._free: List[int] = []     # released, to reuse
+        self._owners          = weakref.WeakValueDictionary()
+
+        self.reseed()
+
+        if hasattr(os, "register_at_fork"):  # python >= 3.7
+            os.register_at_fork(after_in_child=self._after_fork)
+
+
+    def __len__(self) -> int:
+        return len(self._live) + len(self._owners)
+
+
+    def __contains__(self, id: int) -> bool:
+        return id in self._live or id in self._owners
+
+
+    def reseed(self) -> None:
+        with self._lock:
+            self._next = random.SystemRandom().randint(self.min_id,
+                                                       self.max_id)
+
+
+    def _after_fork(self) -> None:
+        # The parent may reuse the ids it released too, and continues its
+        # own sequence: start another one.
+        self._lock = threading.Lock()
+        self._free = []
+        self.reseed()
+
+
+    def _take(self, id: int, owner: Any) -> None:
+        if owner is None:
+            self._live.add(id)
+        else:
+            self._live.discard(id)
+            self._owners[id] = owner
+
+
+    def allocate(self, owner: Any = None) -> int:
+        with self._lock:
+            while self._free:
+                id = self._free.pop()
+                if id not in self:  # may have been reserved since
+                    self._take(id, owner)
+                    return id
+
+            if len(self) > self.max_id - self.min_id:
+                raise RuntimeError("All image ids are in use")
+
+            id = self._next
+            while id in self:
+                id = id + 1 if id < self.max_id else self.min_id
+
+            self._next = id + 1 if id < self.max_id else self.min_id
+            self._take(id, owner)
+            return id
+
+
+    def reserve(self, id: int, owner: Any = None) -> None:
+        # Mark an id chosen by the user as used, or hand an id over to
+        # another owner.
+        assert self.min_id <= id <= self.max_id, id
+
+        with self._lock:
+            self._take(id, owner)
+
+
+    def owner(self, id: int) -> Optional[Any]:
+        return self._owners.get(id)
+
+
+    def release(self, id: int) -> None:
+        with self._lock:
+            if id in self:
+                self._live.discard(id)
+                self._owners.pop(id, None)
+                self._free.append(id)
+
+
+    def forget(self, id: int) -> None:
+        # Stop tracking an id without reusing it soon, e.g. for images that
+        # may still be displayed.
+        with self._lock:
+            self._live.discard(id)
+            self._owners.pop(id, None)
@@ -1,58 +1,197 @@
 # Copyright 2018 miruka
 # This file is part of pixcat, licensed under LGPLv3.
 
+import asyncio
+import functools
+import hashlib
 import io
+import itertools
 import math
-import random
 import re
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from tempfile import NamedTemporaryFile
-from typing import Dict, Generator, Optional, Tuple, Union
+from typing import Dict, Generator, Iterable, List, Optional, Tuple, Union
 
 from dataclasses import InitVar, dataclass, field
 from PIL import Image as PILImage
 
-from . import data
-from .terminal import TERM
+from . import decoders, encoding, fallback
+from .ids import IdAllocator
+from .index import Entry, Index
+from .terminal import TERM, KittyAnswerError
+
+# Objects with a shape like NumPy arrays can be used too, see PixelBuffer.
+# Files of index entries are only opened once their pixels are needed.
+ImageType = Union[
+    bytes, str, Path, PILImage.Image, encoding.PixelBuffer, Entry
+]
+
+class _Content:
+    # Pixels shared by deduplicated images, its id is in use as long as
+    # images using it exist.
+    __slots__ = ("digest", "id", "users", "transmitted", "__weakref__")
+
+    def __init__(self, digest: bytes) -> None:
+        self.digest      = digest
+        self.id          = Image.ids.allocate(owner=self)
+        self.users       = weakref.WeakValueDictionary()  # {id(image): image}
+        self.transmitted = False
 
-ImageType = Union[bytes, str, Path, PILImage.Image]
 
 @dataclass
 class Image:
-    min_id   = data.MIN_ID
-    max_id   = data.MAX_ID
-    used_ids = set()
+    ids = IdAllocator()  # images own their id, it's forgotten on collection
+
+    # If True, images with identical pixels share one id in the terminal
+    # and are only transmitted once, then just placed again.
+    deduplicate = False
+    contents    = weakref.WeakValueDictionary()  # {content hash: _Content}
+
+    _placement_ids = itertools.count(1)
 
     source: InitVar[ImageType]
     id:     Optional[int] = None
 
     origin: ImageType = field(init=False, default=None)
 
-    _pil_image: PILImage.Image = field(init=False, repr=False, default=None)
+    _pil: Optional[PILImage.Image] = field(init=False, repr=False,
+                                           default=None)
+
+    # Dimensions known without opening the file, e.g. from an index entry
+    _size: Optional[Tuple[int, int]] = \
+        field(init=False, repr=False, compare=False, default=None)
+
+    # Raw pixels of array and buffer sources, which can change anytime:
+    # they're transmitted again on each show (or hashed again when
+    # deduplicating), and a PIL image is made from them when needed.
+    # Resized images are copies made from the pixels at that time.
+    _buffer: Optional[encoding.PixelBuffer] = \
+        field(init=False, repr=False, compare=False, default=None)
 
     _resized_cache: Dict[Tuple[str, tuple], "Image"] = \
         field(init=False, repr=False, compare=False, default_factory=dict)
 
+    _transmitted: bool = field(init=False, repr=False, compare=False,
+                               default=False)
+
+    # Infos on the last encoding done to transmit the image
+    stats: Optional[dict] = field(init=False, repr=False, compare=False,
+                                  default=None)
+
+    _content_hash: Optional[bytes] = \
+        field(init=False, repr=False, compare=False, default=None)
+
+    # Shared pixels whose id this image uses when deduplicating, and ids
+    # of this image's own placements of them
+    _content: Optional[_Content] = \
+        field(init=False, repr=False, compare=False, default=None)
+
+    _placements: Optional[List[int]] = \
+        field(init=False, repr=False, compare=False, default=None)
+
 
     def __post_init__(self, source) -> None:
         self._resized_cache = {}  # to make pylint shut up
         self.origin         = source
-        self.id             = self._get_id()
-        self._pil_image     = self._get_pil_image(source)
+        self._buffer        = self._get_pixel_buffer(source)
+
+        if self.id is None:
+            self.id = self.ids.allocate(owner=self)
+        else:
+            self.ids.reserve(self.id, owner=self)
+
+        if isinstance(source, Entry):
+            self.origin = Path(source.path)
+            self._size  = (source.width, source.height)
+        elif not self._buffer:
+            self._pil_image = self._get_pil_image(source)
+
+
+    @classmethod
+    def _get_id(cls) -> int:
+        return cls.ids.allocate()
+
+
+    def _set_id(self, id: int, owned: bool = True) -> None:
+        # Let go of the current id, then use another one, taking it over
+        # from its current owner if owned.
+        self._let_go_id(reuse=not self._transmitted)
+        self.id = id
 
+        if owned:
+            self.ids.reserve(id, owner=self)
 
-    def _get_id(self) -> int:
-        # Avoid hanging if somehow more than 4 billion of ids are registered:
-        if len(self.used_ids) >= self.max_id:
-            self.used_ids = set()
 
-        random_id = random.randint(self.min_id, self.max_id)
+    def _let_go_id(self, reuse: bool) -> None:
+        content, self._content = self._content, None
 
-        while random_id in self.used_ids:
-            random_id = random.randint(self.min_id, self.max_id)
+        if content:
+            content.users.pop(id(self), None)
 
-        self.used_ids.add(random_id)
-        return random_id
+            if not content.users:  # we were the last one using it
+                self.contents.pop(content.digest, None)
+                self._let_go(content.id, reuse and not content.transmitted)
+
+        elif self.ids.owner(self.id) is self:
+            self._let_go(self.id, reuse)
+
+
+    @classmethod
+    def _let_go(cls, id: int, reuse: bool) -> None:
+        # Ids that may still be displayed are only reused much later
+        if reuse:
+            cls.ids.release(id)
+        else:
+            cls.ids.forget(id)
+
+
+    @classmethod
+    def from_buffer(cls,
+                    buffer,
+                    size: Tuple[int, int],
+                    mode: str           = "RGB",
+                    id:   Optional[int] = None) -> "Image":
+
+        # buffer: flat raw pixels, e.g. bytearray, mmap or memoryview
+        return cls(encoding.PixelBuffer.from_buffer(buffer, size, mode), id)
+
+
+    @staticmethod
+    def _get_pixel_buffer(source) -> Optional[encoding.PixelBuffer]:
+        if isinstance(source, encoding.PixelBuffer):
+            return source
+
+        if isinstance(source, (bytes, str, Path, PILImage.Image, Entry)):
+            return None
+
+        return encoding.PixelBuffer.from_array(source)
+
+
+    @property
+    def _pil_image(self) -> PILImage.Image:
+        if self._buffer:
+            return self._buffer.to_pil()
+
+        if self._pil is None and self._size:  # not opened yet
+            self._pil = self._get_pil_image(self.origin)
+
+        return self._pil
+
+    @_pil_image.setter
+    def _pil_image(self, value: PILImage.Image) -> None:
+        self._pil  = value
+        self._size = None
+
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        if self._buffer:
+            return self._buffer.size
+
+        return self._size or self._pil_image.size
 
 
     def _get_pil_image(self, source) -> PILImage.Image:
@@ -66,29 +205,104 @@ class Image:
             source = req.content    # bytes
 
         if isinstance(source, bytes):
-            # Don't use `with`  here, or _get_kitty_file() will fail.
-            out = io.BytesIO()
-            out.write(source)
-            out.seek(0)
-            return PILImage.open(out)
+            # Don't use `with`  here, or _get_transmission() will fail.
+            return PILImage.open(io.BytesIO(source))
 
         self.origin = path = Path(source).expanduser().resolve()
         return PILImage.open(path)
 
 
-    def _get_kitty_file(self) -> str:
-        dest = NamedTemporaryFile(prefix=".pixcat-", delete=False)
-        self._pil_image.save(dest.name, format="PNG", compress_level=0)
-        return dest.name
+    def _get_content_hash(self) -> bytes:
+        if not self._content_hash or self._buffer:
+            pixels = self._buffer or self._pil_image
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(f"{pixels.mode}{pixels.size}".encode())
+            digest.update(
+                self._buffer.data if self._buffer else pixels.tobytes()
+            )
+            self._content_hash = digest.digest()
+
+        return self._content_hash
+
+
+    def _use_content_id(self) -> None:
+        if not self.deduplicate:
+            return
+
+        digest = self._get_content_hash()
+
+        if not self._content or self._content.digest != digest:
+            content = self.contents.get(digest)
+
+            if not content:
+                content = self.contents[digest] = _Content(digest)
+
+            # Our own id was superseded, give it back
+            self._set_id(content.id, owned=False)
+            self._content           = content
+            content.users[id(self)] = self
+
+        self._transmitted = self._content.transmitted
+
+
+    def _add_placement_id(self, controls: dict) -> None:
+        # Deduplicated images share their id, give each placement its own
+        # so that hide() can only delete this image's placements.
+        if not self._content:
+            return
+
+        placement_id = controls.setdefault("placement_id",
+                                           next(self._placement_ids))
+
+        if placement_id not in (self._placements or ()):
+            self._placements = (self._placements or []) + [placement_id]
+
+
+    def _set_transmitted(self, transmitted: bool) -> None:
+        self._transmitted = transmitted and not self._buffer
+
+        if self._content:
+            self._content.transmitted = transmitted
+
+
+    def _get_transmission(self, medium: Optional[str] = None) -> dict:
+        # Controls and payload for kitty to receive this image's data
+        started = time.perf_counter()
+        medium  = medium or TERM.medium
+        pixels  = self._buffer or self._pil_image
+        plan    = encoding.plan_encoding(pixels, medium)
+        encoded = encoding.encode(pixels, plan)
+
+        controls = {"medium": medium, "format": plan.format}
+
+        if plan.format != "png":
+            controls["source_w"], controls["source_h"] = self.size
+
+        if plan.compress:
+            controls["compress"] = plan.compress
+
+        if medium == "direct":
+            controls["payload"] = encoded
+        else:
+            with NamedTemporaryFile(prefix=".pixcat-", delete=False) as dest:
+                dest.write(encoded)
+            controls["payload"] = dest.name
+
+        self.stats = {
+            "encoding":    plan,
+            "bytes":       len(encoded),
+            "encode_time": time.perf_counter() - started,
+        }
+        return controls
 
 
     @property
     def cols(self) -> int:
-        return math.ceil(self._pil_image.size[0] / TERM.cell_px_width)
+        return math.ceil(self.size[0] / TERM.cell_px_width)
 
     @property
     def rows(self) -> int:
-        return math.ceil(self._pil_image.size[1] / TERM.cell_px_height)
+        return math.ceil(self.size[1] / TERM.cell_px_height)
 
 
     @staticmethod
@@ -100,81 +314,165 @@ class Image:
         return num if num >= 0 else TERM.cell_px_height * abs(num)
 
 
+    def _get_resize_size(self,
+                         min_w:   int           = 1,
+                         min_h:   int           = 1,
+                         max_w:   Optional[int] = None,
+                         max_h:   Optional[int] = None,
+                         stretch: bool          = False) -> Tuple[int, int]:
+
+        return _get_resize_size(self.size, min_w, min_h, max_w, max_h, stretch)
+
+
     def resize(self,
-               min_w:    int           = 1,
-               min_h:    int           = 1,
-               max_w:    Optional[int] = None,
-               max_h:    Optional[int] = None,
-               stretch:  bool          = False,
-               resample: str           = "lanczos") -> "Image":
+               min_w:        int             = 1,
+               min_h:        int             = 1,
+               max_w:        Optional[int]   = None,
+               max_h:        Optional[int]   = None,
+               stretch:      bool            = False,
+               resample:     str             = "lanczos",
+               reducing_gap: Optional[float] = None) -> "Image":
 
-        w, h = img_w, img_h = self._pil_image.size
+        w, h = self._get_resize_size(min_w, min_h, max_w, max_h, stretch)
 
-        max_w = max_w or img_w
-        max_h = max_h or img_h
+        # Nothing to do:
+        if (w, h) == self.size:
+            return self
 
-        min_w = self._negative_col_to_px(min_w)
-        min_h = self._negative_row_to_px(min_h)
-        max_w = self._negative_col_to_px(max_w)
-        max_h = self._negative_row_to_px(max_h)
+        # If an image was already made for decided width/height, return it:
 
-        assert min_w <= max_w
-        assert min_h <= max_h
+        cached = self._resized_cache.get((w, h))
+        if cached:
+            return cached
 
-        # Upscale if image is smaller than minimum width/height:
-        if (img_w < min_w or img_h < min_h) and img_w < max_w and img_h <max_h:
+        # Return and save in the cache dict an Image object of the resized.
 
-            if stretch:
-                w, h = min_w, min_h
+        pil_image = self._get_resize_base((w, h))
 
-            elif min_w >= min_h:
-                # If calculated height > max_h: max_h, if < min_h: min_h
-                h = min(max_h, math.ceil((min_w / img_w) * img_h))
-                w = math.floor((h / img_h) * img_w)
+        if pil_image.size != (w, h):
+            resample  = getattr(PILImage, resample.upper())
+            pil_image = pil_image.resize(
+                (w, h), resample, reducing_gap=reducing_gap
+            )
 
-            else:
-                w = min(max_w, math.ceil((min_h / img_h) * img_w))
-                h = math.floor((w / img_w) * img_h)
+        image = type(self)(pil_image)
 
-        # Downscale if image is bigger than maximum width/height:
-        elif img_w > max_w or img_h > max_h:
+        self._resized_cache[(w, h)] = image
+        return image
 
-            if stretch:
-                w, h = max_w, max_h
 
-            elif max_w >= max_h:
-                h = min(max_h, math.ceil((max_w / img_w) * img_h))
-                w = math.floor((h / img_h) * img_w)
+    def _get_resize_base(self, size: Tuple[int, int]) -> PILImage.Image:
+        # When shrinking, e.g. for fit_screen after a terminal resize,
+        # start from the smallest bigger resized image we already have with
+        # the same aspect ratio, instead of the whole original.
+        w, h  = size
+        bases = [
+            image for (cached_w, cached_h), image in
+            self._resized_cache.items()
+            if cached_w >= w and cached_h >= h and
+               abs(cached_w / cached_h - w / h) < 0.01
+        ]
 
-            else:
-                w = min(max_w, math.ceil((max_h / img_h) * img_w))
-                h = math.floor((w / img_w) * img_h)
+        if bases:
+            return min(bases, key=lambda image: image.size)._pil_image
 
-        # Nothing to do:
-        else:
-            return self
+        # Otherwise decode again at a reduced scale when the decoders can
+        if self._can_redecode and w <= self.size[0] and h <= self.size[1]:
+            return decoders.decode(self.origin, size)
 
-        # If an image was already made for decided width/height, return it:
+        return self._pil_image
 
-        cached = self._resized_cache.get((w, h))
+
+    def _resize_from_fresh_source(self,
+                                  size:         Tuple[int, int],
+                                  resample:     str,
+                                  reducing_gap: Optional[float]) -> "Image":
+
+        cached = self._resized_cache.get(size)
         if cached:
             return cached
 
-        # Return and save in the cache dict an Image object of the resized.
+        # Decode again when we can, so that this image doesn't keep the full
+        # decoded pixels around afterwards, and so that decoders can work
+        # directly at a reduced scale.
+        if self._can_redecode:
+            pil_image = decoders.decode(self.origin, size)
+        else:
+            pil_image = self._pil_image
 
-        resample = getattr(PILImage, resample.upper())
-        image    = type(self)(self._pil_image.resize((w, h), resample))
+        if pil_image.size != size:
+            resample  = getattr(PILImage, resample.upper())
+            pil_image = pil_image.resize(
+                size, resample, reducing_gap=reducing_gap
+            )
 
-        self._resized_cache[(w, h)] = image
+        image = type(self)(pil_image)
+
+        self._resized_cache[size] = image
         return image
 
 
+    @classmethod
+    def resize_many(cls,
+                    images:       Iterable["Image"],
+                    min_w:        int             = 1,
+                    min_h:        int             = 1,
+                    max_w:        Optional[int]   = None,
+                    max_h:        Optional[int]   = None,
+                    stretch:      bool            = False,
+                    resample:     str             = "lanczos",
+                    reducing_gap: Optional[float] = 2.0,
+                    workers:      Optional[int]   = None,
+                    raise_errors: bool            = True
+                   ) -> List[Optional["Image"]]:
+
+        def resize_one(image: "Image") -> Optional["Image"]:
+            try:
+                size = image._get_resize_size(min_w, min_h, max_w, max_h,
+                                              stretch)
+
+                if size == image.size:
+                    return image
+
+                return image._resize_from_fresh_source(
+                    size, resample, reducing_gap
+                )
+
+            except Exception:
+                if raise_errors:
+                    raise
+                return None
+
+        with ThreadPoolExecutor(workers) as pool:
+            return list(pool.map(resize_one, images))
+
+
+    @staticmethod
+    def _resize_params(min_w:    int           = 1,
+                       min_h:    int           = 1,
+                       max_w:    Optional[int] = None,
+                       max_h:    Optional[int] = None,
+                       stretch:  bool          = False,
+                       resample: str           = "lanczos") -> dict:
+
+        return {"min_w": min_w, "min_h": min_h, "max_w": max_w,
+                "max_h": max_h, "stretch": stretch, "resample": resample}
+
+
     def thumbnail(self,
                   size:     int  = 256,
                   stretch:  bool = False,
                   resample: str  = "lanczos") -> "Image":
 
-        return self.resize(*(size,) * 4, stretch, resample)
+        return self.resize(**self._thumbnail_params(size, stretch, resample))
+
+
+    def _thumbnail_params(self,
+                          size:     int  = 256,
+                          stretch:  bool = False,
+                          resample: str  = "lanczos") -> dict:
+
+        return self._resize_params(*(size,) * 4, stretch, resample)
 
 
     def fit_screen(self,
@@ -184,13 +482,76 @@ class Image:
                    stretch:  bool = False,
                    resample: str  = "lanczos") -> "Image":
 
+        return self.resize(**self._fit_screen_params(
+            h_margin, v_margin, enlarge, stretch, resample
+        ))
+
+
+    def _fit_screen_params(self,
+                           h_margin: int  = 0,
+                           v_margin: int  = 0,
+                           enlarge:  bool = False,
+                           stretch:  bool = False,
+                           resample: str  = "lanczos") -> dict:
+
         h_margin = self._negative_col_to_px(h_margin) * 4
         v_margin = self._negative_row_to_px(v_margin) * 4
 
         max_wh = (TERM.px_width - h_margin, TERM.px_height - v_margin)
         min_wh =  max_wh if enlarge else (1, 1)
 
-        return self.resize(*min_wh, *max_wh, stretch, resample)
+        return self._resize_params(*min_wh, *max_wh, stretch, resample)
+
+
+    @property
+    def _can_redecode(self) -> bool:
+        # Whether the source can be decoded independently from _pil_image
+        return isinstance(self.origin, (Path, bytes))
+
+
+    def show_progressive(self,
+                         method:           str            = "fit_screen",
+                         method_params:    Optional[dict] = None,
+                         preview_resample: str            = "nearest",
+                         **show_params) -> "Image":
+
+        method_params = method_params or {}
+        resize_params = getattr(self, f"_{method}_params")(**method_params)
+        resize_params.pop("resample")
+        size          = self._get_resize_size(**resize_params)
+
+        if size == self.size or not self._can_redecode:
+            return getattr(self, method)(**method_params).show(**show_params)
+
+        with ThreadPoolExecutor(1) as pool:
+            final = pool.submit(getattr(self, method), **method_params)
+
+            # Decode at a reduced scale closest to the target size if we can
+            preview_pil = decoders.decode(self.origin, size)
+            preview     = type(self)(preview_pil.resize(
+                size, getattr(PILImage, preview_resample.upper())
+            ))
+            preview.deduplicate = False
+
+            # Reserve space first, so that the terminal doesn't scroll
+            # between the two draws and we can restore the cursor position.
+            TERM.print_esc("\n" * preview.rows)
+            TERM.print_esc(TERM.move_relative_y(-preview.rows))
+
+            with TERM.location():
+                preview.show(**show_params)
+
+            final = final.result()
+
+        # Transmitting to the same id replaces the preview in place.
+        # The final image may be cached and shown again later, so a new
+        # one takes over the preview's id instead.
+        placed             = type(self)(final._pil_image)
+        placed.origin      = final.origin
+        placed.deduplicate = False
+
+        placed._set_id(preview.id)
+        return placed.show(**show_params)
 
 
     def show(self,
@@ -202,34 +563,145 @@ class Image:
              align:      str  = "center",
              offset_x:   int  = 0,
              offset_y:   int  = 0,
+             crop_x:     int  = 0,
+             crop_y:     int  = 0,
              crop_w:     int  = 0,
              crop_h:     int  = 0) -> "Image":
 
-        assert align in ("left", "center", "right")
+        cursor, controls = self._show_args(
+            x, y, z, relative_x, relative_y, align,
+            offset_x, offset_y, crop_x, crop_y, crop_w, crop_h
+        )
 
-        crop_w = self._negative_col_to_px(crop_w)
-        crop_h = self._negative_row_to_px(crop_h)
+        if TERM.renderer != "kitty":
+            self._show_fallback(cursor, controls)
+            return self
 
-        params = {
-            "offset_x": offset_x, "offset_y": offset_y,
-            "crop_w":   crop_w,   "crop_h":   crop_h,
-            "z_index":  z,
+        self._move_cursor(*cursor)
+        self._place(**controls)
+        return self
+
+
+    def _show_fallback(self, cursor: tuple, controls: dict) -> None:
+        # Draw with text or sixels, offsets and z-index can't be honored
+        pil_image = self._pil_image
+        crop_x, crop_y = controls["crop_x"], controls["crop_y"]
+
+        if any((crop_x, crop_y, controls["crop_w"], controls["crop_h"])):
+            pil_image = pil_image.crop((
+                crop_x,
+                crop_y,
+                crop_x + (controls["crop_w"] or pil_image.width - crop_x),
+                crop_y + (controls["crop_h"] or pil_image.height - crop_y),
+            ))
+
+        if controls.get("fit_cols"):  # scale to fill these cells like kitty
+            pil_image = pil_image.resize((
+                controls["fit_cols"] * TERM.cell_px_width,
+                controls["fit_rows"] * TERM.cell_px_height,
+            ))
+
+        cols = math.ceil(pil_image.width / TERM.cell_px_width)
+        rows = math.ceil(pil_image.height / TERM.cell_px_height)
+
+        self._move_cursor(*cursor[:-1], cols)
+
+        if TERM.renderer == "sixel":
+            TERM.print_esc(fallback.sixel(pil_image))
+            return
+
+        render = getattr(fallback, TERM.renderer)
+        col    = TERM.get_location()[1]
+        lines  = render(pil_image, cols, rows)
+        TERM.print_esc(("\n" + TERM.move_x(col)).join(lines))
+
+
+    async def ashow(self, **show_params) -> "Image":
+        # Same parameters as show(). Encoding happens in an executor, and
+        # concurrent calls take turns for cursor movements and placements.
+        cursor, controls = self._show_args(**show_params)
+        transmission     = None
+
+        if TERM.renderer == "kitty":
+            self._use_content_id()
+            self._add_placement_id(controls)
+
+        if TERM.renderer == "kitty" and not self._transmitted:
+            transmission = await _in_executor(self._get_transmission)
 
-            "action": "transmit+display",
-            "medium" : "tempfile",
-            "format" : "png",
-            "id":      self.id,
-            "payload": self._get_kitty_file(),
+        if TERM.renderer != "kitty":
+            async with TERM.async_lock:
+                await _draw_in_executor(self._show_fallback, cursor, controls)
+            return self
+
+        async with TERM.async_lock:
+            # Moving relatively reads the cursor position, a blocking read
+            await _draw_in_executor(self._move_cursor, *cursor)
+
+            if transmission is None:
+                try:
+                    await TERM.arun_code(action="display", id=self.id,
+                                         **controls)
+                    return self
+                except KittyAnswerError:
+                    transmission = await _in_executor(self._get_transmission)
+
+            await TERM.arun_code(
+                action = "transmit+display",
+                id     = self.id,
+                **transmission,
+                **controls
+            )
+            self._set_transmitted(True)
+
+        return self
+
+
+    def _show_args(self,
+                   x:          Optional[int] = None,
+                   y:          Optional[int] = None,
+                   z:          int  = -1,
+                   relative_x: int  = 0,
+                   relative_y: int  = 0,
+                   align:      str  = "center",
+                   offset_x:   int  = 0,
+                   offset_y:   int  = 0,
+                   crop_x:     int  = 0,
+                   crop_y:     int  = 0,
+                   crop_w:     int  = 0,
+                   crop_h:     int  = 0) -> Tuple[tuple, dict]:
+
+        cursor   = (x, y, relative_x, relative_y, align, self.cols)
+        controls = {
+            "offset_x": offset_x,
+            "offset_y": offset_y,
+            "crop_x":   self._negative_col_to_px(crop_x),
+            "crop_y":   self._negative_row_to_px(crop_y),
+            "crop_w":   self._negative_col_to_px(crop_w),
+            "crop_h":   self._negative_row_to_px(crop_h),
+            "z_index":  z,
         }
+        return (cursor, controls)
+
+
+    def _move_cursor(self,
+                     x:          Optional[int],
+                     y:          Optional[int],
+                     relative_x: int,
+                     relative_y: int,
+                     align:      str,
+                     cols:       int) -> None:
+
+        assert align in ("left", "center", "right")
 
         if x is not None:
             TERM.print_esc(TERM.move_x(x))
 
         elif align == "center":
-            relative_x += round(TERM.width / 2) - round(self.cols / 2)
+            relative_x += round(TERM.width / 2) - round(cols / 2)
 
         elif align == "right":
-            relative_x += TERM.width - self.cols
+            relative_x += TERM.width - cols
 
         if relative_x:
             TERM.print_esc(TERM.move_relative_x(relative_x))
@@ -241,23 +713,219 @@ class Image:
             TERM.print_esc(TERM.move_relative_y(relative_y))
 
 
-        # import time; time.sleep(2)
-        TERM.run_code(**params)
+    def _place(self, transmission: Optional[dict] = None, **controls
+              ) -> None:
+        # Display the image at the cursor, only transmitting it if needed.
+        # transmission: an already made _get_transmission() result to use.
+        self._use_content_id()
+        self._add_placement_id(controls)
+
+        if self._transmitted:
+            try:
+                TERM.run_code(action="display", id=self.id, **controls)
+                return
+            except KittyAnswerError:
+                pass  # kitty may have evicted the image data, send it again
+
+        TERM.run_code(
+            action = "transmit+display",
+            id     = self.id,
+            **(transmission or self._get_transmission()),
+            **controls
+        )
+        self._set_transmitted(True)
+
+
+    def transmit(self) -> "Image":
+        if TERM.renderer != "kitty":
+            raise ValueError(
+                f"Images can't be transmitted with the {TERM.renderer} "
+                f"renderer, only with kitty."
+            )
+
+        self._use_content_id()
+
+        if not self._transmitted:
+            TERM.run_code(action="transmit", id=self.id,
+                          **self._get_transmission())
+            self._set_transmitted(True)
+
+        return self
+
+
+    def _get_viewport(self,
+                      zoom:  float,
+                      pan_x: int,
+                      pan_y: int,
+                      cols:  int,
+                      rows:  int) -> Tuple[int, int, int, int]:
+
+        # Source rectangle of the image that fits cols x rows at this zoom,
+        # kept inside the image.
+        img_w, img_h = self.size
+
+        w = max(1, min(img_w, round(cols * TERM.cell_px_width / zoom)))
+        h = max(1, min(img_h, round(rows * TERM.cell_px_height / zoom)))
+        x = max(0, min(pan_x, img_w - w))
+        y = max(0, min(pan_y, img_h - h))
+        return (x, y, w, h)
+
+
+    def show_viewport(self,
+                      zoom:         float         = 1,
+                      pan_x:        int           = 0,
+                      pan_y:        int           = 0,
+                      cols:         Optional[int] = None,
+                      rows:         Optional[int] = None,
+                      x:            Optional[int] = None,
+                      y:            Optional[int] = None,
+                      z:            int           = -1,
+                      relative_x:   int           = 0,
+                      relative_y:   int           = 0,
+                      align:        str           = "center",
+                      placement_id: int           = 1) -> "Image":
+
+        # The image is transmitted once, then only re-placed with a different
+        # source rectangle and scaling: zooming and panning are cheap.
+        cols = cols or min(TERM.width, math.ceil(self.cols * zoom))
+        rows = rows or min(TERM.height - 1, math.ceil(self.rows * zoom))
+
+        crop_x, crop_y, crop_w, crop_h = \
+            self._get_viewport(zoom, pan_x, pan_y, cols, rows)
+
+        cols = min(cols, math.ceil(crop_w * zoom / TERM.cell_px_width))
+        rows = min(rows, math.ceil(crop_h * zoom / TERM.cell_px_height))
+
+        cursor   = (x, y, relative_x, relative_y, align, cols)
+        controls = {
+            "crop_x":       crop_x,
+            "crop_y":       crop_y,
+            "crop_w":       crop_w,
+            "crop_h":       crop_h,
+            "fit_cols":     cols,
+            "fit_rows":     rows,
+            "z_index":      z,
+            "placement_id": placement_id,
+            "cursor":       "stay",
+        }
+
+        if TERM.renderer != "kitty":
+            self._show_fallback(cursor, controls)
+            return self
+
+        self._move_cursor(*cursor)
+        self._place(**controls)
+        return self
+
+
+    def inspect(self,
+                zoom_step: float = 1.25,
+                align:     str   = "center") -> "Image":
+
+        cols, rows = TERM.width, TERM.height - 1
+        zoom       = min(1, cols / self.cols, rows / self.rows)
+        pan_x      = pan_y = 0
+
+        # Reserve the screen, so that the viewport can always be redrawn
+        # at the same place.
+        TERM.print_esc("\n" * rows)
+        top = TERM.get_location()[0] - rows
+
+        with TERM.cbreak(), TERM.hidden_cursor():
+            while True:
+                pan_x, pan_y, view_w, view_h = \
+                    self._get_viewport(zoom, pan_x, pan_y, cols, rows)
+
+                TERM.print_esc(TERM.move(top, 0))
+                self.show_viewport(zoom, pan_x, pan_y, cols, rows,
+                                   align=align)
+
+                key = TERM.inkey()
+
+                if key == "q" or key.code == TERM.KEY_ESCAPE:
+                    break
+                elif key in ("+", "="):
+                    zoom *= zoom_step
+                elif key == "-":
+                    zoom /= zoom_step
+                elif key == "0":
+                    zoom = min(1, cols / self.cols, rows / self.rows)
+                elif key == "h" or key.code == TERM.KEY_LEFT:
+                    pan_x -= view_w // 4
+                elif key == "l" or key.code == TERM.KEY_RIGHT:
+                    pan_x += view_w // 4
+                elif key == "k" or key.code == TERM.KEY_UP:
+                    pan_y -= view_h // 4
+                elif key == "j" or key.code == TERM.KEY_DOWN:
+                    pan_y += view_h // 4
+
+        TERM.print_esc(TERM.move(top + rows, 0))
         return self
 
 
     def hide(self, resized_too: bool = True) -> "Image":
-        ids = [self.id]
+        images = [self]
 
         if resized_too:
-            ids += [img.id for img in self._resized_cache.values()]
+            images += list(self._resized_cache.values())
+
+        if TERM.renderer != "kitty":
+            return self  # text can't be removed without erasing the screen
 
-        for id_ in ids:
-            TERM.run_code(action="delete", del_data_target="id", id=id_)
+        for image in images:
+            placements, image._placements = image._placements or [], None
+            content                       = image._content
+
+            # Content ids are shared, only delete our placements if others
+            # still use it
+            if content and len(content.users) > 1:
+                for placement_id in placements:
+                    TERM.run_code(action="delete", del_target="id",
+                                  id=image.id, placement_id=placement_id)
+                continue
+
+            TERM.run_code(action="delete", del_data_target="id", id=image.id)
+            image._set_transmitted(False)
 
         return self
 
 
+    def release(self, resized_too: bool = True) -> None:
+        # Delete the image from the terminal and give its id back for reuse,
+        # it must not be shown again afterwards.
+        images = [self]
+
+        if resized_too:
+            images += list(self._resized_cache.values())
+            self._resized_cache = {}
+
+        for image in images:
+            image.hide(resized_too=False)
+            image._let_go_id(reuse=True)
+
+
+    @classmethod
+    async def aopen(cls, source: ImageType, id: Optional[int] = None
+                   ) -> "Image":
+        # Download and decode in an executor
+        def open_loaded() -> "Image":
+            image = cls(source, id)
+            image._pil_image.load()
+            return image
+
+        return await _in_executor(open_loaded)
+
+
+    async def aresize(self, *args, **kwargs) -> "Image":
+        return await _in_executor(self.resize, *args, **kwargs)
+
+    async def athumbnail(self, *args, **kwargs) -> "Image":
+        return await _in_executor(self.thumbnail, *args, **kwargs)
+
+    async def afit_screen(self, *args, **kwargs) -> "Image":
+        return await _in_executor(self.fit_screen, *args, **kwargs)
+
+
     def copy(self, new_id: Optional[int] = None) -> "Image":
         return type(self)(source=self.origin, id=new_id)
 
@@ -270,8 +938,13 @@ class Image:
     def factory(cls,
                 *sources:      ImageType,
                 raise_errors:  bool = False,
-                print_errors:  bool = True) -> Generator["Image", None, None]:
+                print_errors:  bool = True,
+                index:         Optional[Index] = None,
+                **index_params) -> Generator["Image", None, None]:
 
+        # With an index, folders are listed from its database after an
+        # incremental scan, instead of opening every file they contain.
+        # index_params: sort, reverse, formats... for Index.entries().
         for source in sources:
             try:
                 if isinstance(source, (bytes, PILImage.Image)) or \
@@ -281,6 +954,12 @@ class Image:
 
                 path = Path(source).expanduser().resolve()
 
+                if path.is_dir() and index:
+                    for entry in index.scan(path).entries(path,
+                                                          **index_params):
+                        yield cls(entry)
+                    continue
+
                 if path.is_dir():
                     for item in path.iterdir():
                         yield from cls.factory(
@@ -298,3 +977,72 @@ class Image:
 
                 if print_errors:
                     print(TERM.red("%s: %s" % (type(err).__name__, err)))
+
+
+def _get_resize_size(img_size: Tuple[int, int],
+                     min_w:    int           = 1,
+                     min_h:    int           = 1,
+                     max_w:    Optional[int] = None,
+                     max_h:    Optional[int] = None,
+                     stretch:  bool          = False) -> Tuple[int, int]:
+
+    w, h = img_w, img_h = img_size
+
+    max_w = max_w or img_w
+    max_h = max_h or img_h
+
+    min_w = Image._negative_col_to_px(min_w)
+    min_h = Image._negative_row_to_px(min_h)
+    max_w = Image._negative_col_to_px(max_w)
+    max_h = Image._negative_row_to_px(max_h)
+
+    assert min_w <= max_w
+    assert min_h <= max_h
+
+    # Upscale if image is smaller than minimum width/height:
+    if (img_w < min_w or img_h < min_h) and img_w < max_w and img_h <max_h:
+
+        if stretch:
+            w, h = min_w, min_h
+
+        elif min_w >= min_h:
+            # If calculated height > max_h: max_h, if < min_h: min_h
+            h = min(max_h, math.ceil((min_w / img_w) * img_h))
+            w = math.floor((h / img_h) * img_w)
+
+        else:
+            w = min(max_w, math.ceil((min_h / img_h) * img_w))
+            h = math.floor((w / img_w) * img_h)
+
+    # Downscale if image is bigger than maximum width/height:
+    elif img_w > max_w or img_h > max_h:
+
+        if stretch:
+            w, h = max_w, max_h
+
+        elif max_w >= max_h:
+            h = min(max_h, math.ceil((max_w / img_w) * img_h))
+            w = math.floor((h / img_h) * img_w)
+
+        else:
+            w = min(max_w, math.ceil((max_h / img_h) * img_w))
+            h = math.floor((w / img_w) * img_h)
+
+    return (w, h)
+
+
+async def _in_executor(func, *args, **kwargs):
+    return await asyncio.get_event_loop().run_in_executor(
+        None, functools.partial(func, *args, **kwargs)
+    )
+
+
+async def _draw_in_executor(func, *args, **kwargs):
+    # For use with the terminal lock held: don't release it while the
+    # thread is still drawing if we get cancelled.
+    drawing = asyncio.ensure_future(_in_executor(func, *args, **kwargs))
+    try:
+        return await asyncio.shield(drawing)
+    except asyncio.CancelledError:
+        await asyncio.wait([drawing])
+        raise
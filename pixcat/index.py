@@ -0,0 +1,245 @@
+# Copyright 2018 miruka
+# This file is part of pixcat, licensed under LGPLv3.
+
+import hashlib
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from dataclasses import astuple, dataclass, field
+from PIL import Image as PILImage
+
+from . import data
+from .terminal import TERM
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path     TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size     INTEGER NOT NULL,
+    format   TEXT,     -- NULL if not an image Pillow can identify
+    width    INTEGER,
+    height   INTEGER,
+    hash     TEXT
+);
+CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime_ns);
+CREATE INDEX IF NOT EXISTS files_size  ON files (size);
+"""
+
+SORT_KEYS = {
+    "path":   "path",
+    "mtime":  "mtime_ns",
+    "size":   "size",
+    "format": "format",
+    "width":  "width",
+    "height": "height",
+    "pixels": "width * height",
+}
+
+
+@dataclass
+class Entry:
+    path:     str
+    mtime_ns: int
+    size:     int
+    format:   Optional[str] = None
+    width:    Optional[int] = None
+    height:   Optional[int] = None
+    hash:     Optional[str] = None
+
+
+    @property
+    def is_image(self) -> bool:
+        return self.format is not None
+
+
+@dataclass
+class Index:
+    path: Union[str, Path] = data.INDEX_FILE
+
+    # Hashing means reading whole files, which can be slow on network shares
+    hash_files: bool          = True
+    workers:    Optional[int] = None  # for parallel probing of new files
+
+    print_errors: bool = True
+
+    _db: sqlite3.Connection = field(init=False, repr=False, compare=False)
+
+
+    def __post_init__(self) -> None:
+        self.path = Path(self.path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._db = sqlite3.connect(str(self.path))
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.executescript(SCHEMA)
+
+
+    def __enter__(self) -> "Index":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+    def close(self) -> None:
+        self._db.close()
+
+
+    @staticmethod
+    def _under(location: Path) -> Tuple[str, str, str, str]:
+        # Conditions matching a path and anything inside it, using the
+        # primary key's index: "/" and "0" are consecutive characters.
+        where = "(path = ? OR (path >= ? AND path < ?))"
+        return (where, str(location), f"{location}/", f"{location}0")
+
+
+    def scan(self, *locations: Union[str, Path]) -> "Index":
+        # Only files that are new or whose mtime/size changed are opened,
+        # entries for files that disappeared are removed.
+        for location in locations:
+            location = Path(location).expanduser().resolve()
+            where, *args = self._under(location)
+
+            known: Dict[str, Tuple[int, int]] = {
+                path: (mtime_ns, size) for path, mtime_ns, size in
+                self._db.execute(
+                    f"SELECT path, mtime_ns, size FROM files WHERE {where}",
+                    args
+                )
+            }
+
+            found   = dict(self._walk(location))
+            changed = [
+                (path, stat) for path, stat in found.items()
+                if known.get(path) != (stat.st_mtime_ns, stat.st_size)
+            ]
+
+            with ThreadPoolExecutor(self.workers) as pool:
+                entries = list(pool.map(lambda c: self._probe(*c), changed))
+
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (astuple(entry) for entry in entries)
+                )
+                self._db.executemany(
+                    "DELETE FROM files WHERE path = ?",
+                    ((path,) for path in known.keys() - found.keys())
+                )
+
+        return self
+
+
+    def _walk(self, location: Path) -> Iterable[Tuple[str, os.stat_result]]:
+        if not location.is_dir():
+            try:
+                yield (str(location), location.stat())
+            except OSError as err:
+                self._print_error(err)
+            return
+
+        def on_error(err: OSError) -> None:
+            self._print_error(err)
+
+        for root, _, files in os.walk(location, onerror=on_error):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    yield (path, os.stat(path))
+                except OSError as err:
+                    self._print_error(err)
+
+
+    def _probe(self, path: str, stat: os.stat_result) -> Entry:
+        entry = Entry(path, stat.st_mtime_ns, stat.st_size)
+
+        try:
+            # Only reads the header, pixels aren't decoded
+            with PILImage.open(path) as pil_image:
+                entry.format              = pil_image.format
+                entry.width, entry.height = pil_image.size
+        except Exception:  # not an image, keep the entry to not retry it
+            return entry
+
+        if self.hash_files:
+            digest = hashlib.blake2b(digest_size=16)
+
+            with open(path, "rb") as file:
+                for chunk in iter(lambda: file.read(1024 ** 2), b""):
+                    digest.update(chunk)
+
+            entry.hash = digest.hexdigest()
+
+        return entry
+
+
+    def _print_error(self, err: Exception) -> None:
+        if self.print_errors:
+            print(TERM.red("%s: %s" % (type(err).__name__, err)))
+
+
+    def get(self, path: Union[str, Path]) -> Optional[Entry]:
+        row = self._db.execute(
+            "SELECT * FROM files WHERE path = ?",
+            (str(Path(path).expanduser().resolve()),)
+        ).fetchone()
+
+        return Entry(*row) if row else None
+
+
+    def entries(self,
+                *locations: Union[str, Path],
+                sort:       str                     = "path",
+                reverse:    bool                    = False,
+                formats:    Optional[Iterable[str]] = None,
+                min_width:  int                     = 0,
+                min_height: int                     = 0,
+                since:      Optional[float]         = None,
+                images:     bool                    = True) -> List[Entry]:
+
+        # Listing only touches the database, not the filesystem.
+        # locations: only return entries at or under these, default all.
+        # formats: Pillow format names, e.g. JPEG or PNG.
+        # since: minimum modification time, in seconds since the epoch.
+        assert sort in SORT_KEYS
+
+        conditions = []
+        args: list = []
+
+        if locations:
+            unders = [self._under(Path(l).expanduser().resolve())
+                      for l in locations]
+            conditions.append(" OR ".join(u[0] for u in unders))
+            args += [arg for under in unders for arg in under[1:]]
+
+        if images:
+            conditions.append("format IS NOT NULL")
+
+        if formats:
+            formats = [f.upper() for f in formats]
+            conditions.append(f"format IN ({', '.join('?' * len(formats))})")
+            args += formats
+
+        if min_width:
+            conditions.append("width >= ?")
+            args.append(min_width)
+
+        if min_height:
+            conditions.append("height >= ?")
+            args.append(min_height)
+
+        if since is not None:
+            conditions.append("mtime_ns >= ?")
+            args.append(int(since * 1e9))
+
+        where = " AND ".join(f"({c})" for c in conditions) or "1"
+        order = f"{SORT_KEYS[sort]} {'DESC' if reverse else 'ASC'}, path"
+
+        return [
+            Entry(*row) for row in self._db.execute(
+                f"SELECT * FROM files WHERE {where} ORDER BY {order}", args
+            )
+        ]
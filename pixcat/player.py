@@ -0,0 +1,182 @@
+# Copyright 2018 miruka
+# This file is part of pixcat, licensed under LGPLv3.
+
+import glob
+import itertools
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Deque, Iterable, List, Optional, Tuple, Union
+
+from dataclasses import dataclass, field
+from PIL import Image as PILImage
+
+from .image import Image
+from .terminal import TERM
+
+# Resized image, ready to send transmission or None for non-kitty renderers
+Frame = Tuple[Image, Optional[dict]]
+
+
+@dataclass
+class Player:
+    frames: List[Union[str, Path]]
+
+    fps:         float         = 24
+    prefetch:    int           = 8     # max frames decoded ahead
+    workers:     Optional[int] = None
+    drop_frames: bool          = True  # skip frames we're too late to show
+    loop:        bool          = False
+
+    # Parameters for Image.fit_screen(), None to not resize frames
+    fit_screen_params: Optional[dict] = field(default_factory=dict)
+
+    print_errors: bool = True
+
+    displayed: int = field(init=False, default=0)
+    dropped:   int = field(init=False, default=0)
+
+    id: int = field(init=False, default_factory=Image._get_id)  # of frames
+
+
+    def __post_init__(self) -> None:
+        Image.ids.reserve(self.id, owner=self)
+
+
+    @classmethod
+    def from_locations(cls, *locations: Union[str, Path], **kwargs
+                      ) -> "Player":
+        # Folders are scanned recursively, strings can be glob patterns.
+        # Only files with image extensions are picked from those, in
+        # natural order (frame2 before frame10).
+        frames = []
+
+        for location in locations:
+            path = Path(location).expanduser()
+
+            if path.is_dir():
+                frames += _sort_frames(path.rglob("*"))
+
+            elif glob.has_magic(str(path)):
+                frames += _sort_frames(Path(p) for p in glob.glob(str(path)))
+
+            else:
+                frames.append(path)
+
+        return cls(frames, **kwargs)
+
+
+    def _prepare_frame(self, source: Union[str, Path]) -> Frame:
+        image = Image(source)
+
+        if self.fit_screen_params is not None:
+            image = image.fit_screen(**self.fit_screen_params)
+
+        # Other renderers draw from the pixels, nothing to encode
+        if TERM.renderer != "kitty":
+            return (image, None)
+
+        return (image, image._get_transmission())
+
+
+    @staticmethod
+    def _discard(future: Future) -> None:
+        def remove_file(future: Future) -> None:
+            if future.cancelled() or future.exception():
+                return
+
+            transmission = future.result()[1]
+            if transmission and transmission["medium"] == "tempfile":
+                os.remove(transmission["payload"])
+
+        if not future.cancel():
+            future.add_done_callback(remove_file)
+
+
+    def play(self, **show_params) -> "Player":
+        # Parameters are the same as Image.show()
+        sources = itertools.cycle(self.frames) if self.loop else \
+                  iter(self.frames)
+
+        pending: Deque[Future] = deque()
+        reserved_rows          = 0
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            def refill() -> None:
+                while len(pending) < self.prefetch:
+                    source = next(sources, None)
+                    if source is None:
+                        return
+                    pending.append(pool.submit(self._prepare_frame, source))
+
+            refill()
+            start = time.monotonic()
+
+            for index in itertools.count():
+                if not pending:
+                    break
+
+                future = pending.popleft()
+                refill()
+
+                deadline = start + index / self.fps
+                too_late = time.monotonic() > deadline + 1 / self.fps
+
+                # Skip this frame if we're late and the next one is ready,
+                # never drop the last frame so that playback ends on it.
+                if self.drop_frames and too_late and pending and \
+                   pending[0].done():
+                    self._discard(future)
+                    self.dropped += 1
+                    continue
+
+                try:
+                    image, transmission = future.result()
+                except Exception as err:
+                    if self.print_errors:
+                        print(TERM.red("%s: %s" % (type(err).__name__, err)))
+                    continue
+
+                # Reserve space once, so that frames can always be drawn
+                # at the same place without the terminal scrolling.
+                if not reserved_rows:
+                    reserved_rows = image.rows
+                    TERM.print_esc("\n" * reserved_rows)
+                    TERM.print_esc(TERM.move_relative_y(-reserved_rows))
+
+                time.sleep(max(0, deadline - time.monotonic()))
+
+                cursor, controls = image._show_args(**show_params)
+
+                if transmission is None:
+                    with TERM.location():
+                        image._show_fallback(cursor, controls)
+                else:
+                    # Transmitting to the same id replaces the previous frame
+                    image.deduplicate = False
+                    image._set_id(self.id, owned=False)
+
+                    with TERM.location():
+                        image._move_cursor(*cursor)
+                        image._place(transmission, **controls)
+
+                self.displayed += 1
+
+        TERM.print_esc("\n" * reserved_rows)
+        return self
+
+
+def _sort_frames(paths: Iterable[Path]) -> List[Path]:
+    extensions = PILImage.registered_extensions()
+
+    def natural_key(path: Path) -> list:
+        parts = re.split(r"(\d+)", str(path).lower())
+        return [(int(p), p) if p.isdigit() else (-1, p) for p in parts]
+
+    return sorted(
+        (p for p in paths if p.suffix.lower() in extensions and p.is_file()),
+        key = natural_key,
+    )
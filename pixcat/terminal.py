@@ -1,11 +1,16 @@
 import array
+import asyncio
 import base64
 import fcntl
+import os
+import select
 import signal
 import sys
 import termios
+import threading
+import time
 from contextlib import contextmanager
-from typing import Tuple
+from typing import Callable, Optional, Tuple, Union
 
 import blessed
 
@@ -26,6 +31,10 @@ class PixTerminal(blessed.Terminal):
     img_controls        = data.IMAGE_CONTROLS
     esc                 = data.ESC
 
+    _async_lock: Optional[asyncio.Lock] = None
+    _medium:     Optional[str]          = None
+    _renderer:   Optional[str]          = None
+
 
     @property
     def size(self) -> Tuple[int, int]:
@@ -36,6 +45,12 @@ class PixTerminal(blessed.Terminal):
     def px_size(self) -> Tuple[int, int]:
         buf = array.array("H", [0, 0, 0, 0])
         fcntl.ioctl(sys.stdout, termios.TIOCGWINSZ, buf)
+
+        # Some terminals and multiplexers (e.g. tmux) don't report pixels
+        if not buf[2] or not buf[3]:
+            return (self.width * data.DEFAULT_CELL_PX_SIZE[0],
+                    self.height * data.DEFAULT_CELL_PX_SIZE[1])
+
         return (buf[2], buf[3])
 
     @property
@@ -60,7 +75,42 @@ class PixTerminal(blessed.Terminal):
         return self.cell_px_size[1]
 
 
-    def get_code(self, payload: str = "", **controls: str) -> str:
+    @property
+    def medium(self) -> str:
+        # Files written here can't be read by a kitty running on another
+        # machine, send the data in-band instead.
+        if self._medium:
+            return self._medium
+
+        if os.environ.get("SSH_CONNECTION") or os.environ.get("SSH_TTY"):
+            return "direct"
+
+        return "tempfile"
+
+    @medium.setter
+    def medium(self, value: Optional[str]) -> None:
+        self._medium = value
+
+
+    @property
+    def renderer(self) -> str:
+        # tmux doesn't pass the kitty graphics protocol through
+        if self._renderer:
+            return self._renderer
+
+        if os.environ.get("PIXCAT_RENDERER"):
+            return os.environ["PIXCAT_RENDERER"]
+
+        return "halfblock" if os.environ.get("TMUX") else "kitty"
+
+    @renderer.setter
+    def renderer(self, value: Optional[str]) -> None:
+        assert value in (None, *data.RENDERERS)
+        self._renderer = value
+
+
+    def get_code(self, payload: Union[str, bytes] = "", **controls: str
+                ) -> str:
         if "id" in controls:
             assert data.MIN_ID <= controls["id"] <= data.MAX_ID
 
@@ -74,10 +124,28 @@ class PixTerminal(blessed.Terminal):
         keys_str = ",".join([f"{k}={v}" for k, v in real_keys.items()])
 
         if payload:
-            payload = str(base64.b64encode(bytes(payload, "utf-8")), "utf-8")
+            if isinstance(payload, str):
+                payload = bytes(payload, "utf-8")
+
+            payload = str(base64.b64encode(payload), "utf-8")
 
-        # print("%r" % f"{ESC}_G{keys_str};{payload}{ESC}\\")
-        return f"{self.esc}_G{keys_str};{payload}{self.esc}\\"
+        if len(payload) <= data.CHUNK_SIZE:
+            # print("%r" % f"{ESC}_G{keys_str};{payload}{ESC}\\")
+            return f"{self.esc}_G{keys_str};{payload}{self.esc}\\"
+
+        # Big payloads are sent in chunks, only the first one has the keys
+        chunks = [payload[i:i + data.CHUNK_SIZE]
+                  for i in range(0, len(payload), data.CHUNK_SIZE)]
+        m_key, values = self.img_controls["chunks"]
+        partial       = values["partial"]
+        final         = values["final"]
+
+        return "".join(
+            f"{self.esc}_G{keys_str + ',' if i == 0 else ''}"
+            f"{m_key}={final if i == len(chunks) - 1 else partial};"
+            f"{chunk}{self.esc}\\"
+            for i, chunk in enumerate(chunks)
+        )
 
 
     def run_code(self, payload: str = "", timeout: int = 3, **controls: str
@@ -89,25 +157,84 @@ class PixTerminal(blessed.Terminal):
         if controls.get("action", "transmit") not in self.actions_with_answer:
             return
 
-        signal.alarm(timeout)
+        self._check_answer(code, self._read_answer(timeout))
+
+
+    async def arun_code(self, payload: str = "", timeout: int = 3,
+                        **controls: str) -> None:
+
+        code = self.get_code(payload, **controls)
+
+        print(code, flush=True)
+
+        if controls.get("action", "transmit") not in self.actions_with_answer:
+            return
+
+        try:
+            answer = await asyncio.wait_for(self._aread_answer(), timeout)
+        except asyncio.TimeoutError:
+            raise KittyAnswerTimeout()
+
+        self._check_answer(code, answer)
+
+
+    def _read_answer(self, timeout: float) -> str:
+        # Catch responses kitty print on stdin.
+        # Unlike signal.alarm(), select() also works outside the main thread.
+        fd       = sys.stdin.fileno()
+        deadline = time.monotonic() + timeout
+        chars    = []
 
-        # Catch responses kitty print on stdin:
-        chars = []
-        while True:
-            with self.cbreak():
-                char = sys.stdin.read(1)
-                chars.append(char)
-                if char == "\\":
-                    break
+        with self.cbreak():
+            while not chars or chars[-1] != "\\":
+                remaining = deadline - time.monotonic()
+                readable  = remaining > 0 and \
+                            select.select([fd], [], [], remaining)[0]
 
-        signal.alarm(0)  # Cancel alarm
+                if not readable:
+                    raise KittyAnswerTimeout()
 
-        answer = "".join(chars)
+                chars.append(os.read(fd, 1).decode(errors="replace"))
 
+        return "".join(chars)
+
+
+    async def _aread_answer(self) -> str:
+        loop   = asyncio.get_event_loop()
+        fd     = sys.stdin.fileno()
+        answer = loop.create_future()
+        chars  = []
+
+        def on_readable() -> None:
+            chars.append(os.read(fd, 1).decode(errors="replace"))
+
+            if chars[-1] == "\\" and not answer.done():
+                answer.set_result("".join(chars))
+
+        with self.cbreak():
+            loop.add_reader(fd, on_readable)
+            try:
+                return await answer
+            finally:
+                loop.remove_reader(fd)
+
+
+    @staticmethod
+    def _check_answer(code: str, answer: str) -> None:
         if answer and ";OK" not in answer:
             raise KittyAnswerError(code, answer)
 
 
+    @property
+    def async_lock(self) -> asyncio.Lock:
+        # Created lazily, as older asyncio locks bind to the current loop.
+        # Serializes cursor movements and placements of concurrent tasks.
+        if not self._async_lock:
+            self._async_lock = asyncio.Lock()
+
+        return self._async_lock
+
+
     def detect_support(self) -> bool:
         try:
             # Send an useless code that will force a response out of kitty,
@@ -157,16 +284,59 @@ class PixTerminal(blessed.Terminal):
         raise ValueError("Alignement must be 'left', 'center' or 'right'.")
 
 
-    @staticmethod
-    def print_esc(*args, **kwargs) -> None:
-        print(*args, **kwargs, end="", sep="", flush=True)
+    @contextmanager
+    def watch_resize(self) -> threading.Event:
+        # Yield an event set each time the terminal is resized (SIGWINCH).
+        # Signal handlers can only be installed from the main thread.
+        resized  = threading.Event()
+        previous = signal.signal(signal.SIGWINCH, lambda *_: resized.set())
+        try:
+            yield resized
+        finally:
+            signal.signal(signal.SIGWINCH, previous)
 
 
-TERM = PixTerminal()
+    def wait_enter(self,
+                   redraw: Optional[Callable[[], None]] = None,
+                   prompt: str                          = "",
+                   settle: float                        = 0.1) -> None:
+
+        # Wait for an enter keypress, calling redraw after terminal resizes.
+        # A resize sends many signals: only redraw once the size didn't
+        # change for settle seconds.
+        if not redraw or not sys.stdin.isatty():
+            input(prompt)
+            return
+
+        self.print_esc(prompt)
+        pending = False
+
+        with self.watch_resize() as resized:
+            while not select.select([sys.stdin], [], [], settle)[0]:
+                if resized.is_set():
+                    resized.clear()
+                    pending = True
+
+                elif pending:
+                    pending = False
+                    redraw()
+                    self.print_esc(prompt)
+
+        sys.stdin.readline()
 
 
-def alarm_handler(*_):
-    raise KittyAnswerTimeout()
+    def clear_screen(self) -> None:
+        # Remove the text and image placements, but keep the transmitted
+        # image data so that images can be placed again without resending.
+        if self.renderer == "kitty":
+            self.run_code(action="delete", del_target="all")
 
+        self.print_esc(self.clear)
 
-signal.signal(signal.SIGALRM, alarm_handler)
+
+    @staticmethod
+    def print_esc(*args, **kwargs) -> None:
+        print(*args, **kwargs, end="", sep="", flush=True)
+
+
+TERM = PixTerminal()
@@ -0,0 +1,445 @@
+# Copyright 2018 miruka
+# This file is part of pixcat, licensed under LGPLv3.
+
+import hashlib
+import io
+import json
+import math
+import mmap
+import struct
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from dataclasses import dataclass, field
+from PIL import Image as PILImage
+from PIL import ImageFile, TiffImagePlugin, TiffTags
+
+from . import data
+from .image import Image
+from .terminal import TERM
+
+Box  = Tuple[int, int, int, int]
+Tile = tuple  # (decoder name, box, file offset, decoder args)
+
+# Pillow >= 11 expects its own named tuples in PIL.Image.Image.tile
+_make_tile = getattr(ImageFile, "_Tile", lambda *fields: fields)
+
+
+@dataclass
+class Level:
+    path:   Path
+    width:  int
+    height: int
+    mode:   str
+
+
+    @property
+    def stride(self) -> int:
+        return self.width * len(self.mode)
+
+
+    def read(self, x: int, y: int, w: int, h: int) -> PILImage.Image:
+        x, y = max(0, min(x, self.width - 1)), max(0, min(y, self.height - 1))
+        w, h = max(1, min(w, self.width - x)), max(1, min(h, self.height - y))
+
+        start = x * len(self.mode)
+        end   = start + w * len(self.mode)
+
+        # Only the rows of the region are copied out of the mapped file
+        with open(self.path, "rb") as file, \
+             mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+
+            rows = b"".join(
+                mapped[row * self.stride + start:row * self.stride + end]
+                for row in range(y, y + h)
+            )
+
+        return PILImage.frombytes(self.mode, (w, h), rows)
+
+
+@dataclass
+class TiledImage:
+    source: Union[str, Path]
+
+    band_height:    int = 512  # max rows decoded at once when possible
+    min_level_size: int = 256  # stop making pyramid levels below that
+
+    levels: List[Level] = field(init=False, repr=False, default_factory=list)
+
+
+    def __post_init__(self) -> None:
+        self.source = Path(self.source).expanduser().resolve()
+
+
+    @property
+    def cache_dir(self) -> Path:
+        stat = self.source.stat()
+        key  = f"{self.source}:{stat.st_mtime_ns}:{stat.st_size}"
+        return data.PYRAMIDS_DIR / hashlib.sha1(key.encode()).hexdigest()
+
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        self.load_pyramid()
+        return (self.levels[0].width, self.levels[0].height)
+
+
+    def load_pyramid(self) -> List[Level]:
+        if self.levels:
+            return self.levels
+
+        meta_file = self.cache_dir / "meta.json"
+
+        if not meta_file.exists():
+            self._build_pyramid()
+
+        meta        = json.loads(meta_file.read_text())
+        self.levels = [
+            Level(self.cache_dir / f"{i}.raw", w, h, meta["mode"])
+            for i, (w, h) in enumerate(meta["levels"])
+        ]
+        return self.levels
+
+
+    def _open_source(self) -> PILImage.Image:
+        # Bypass the decompression bomb check, huge images are the point here
+        max_pixels, PILImage.MAX_IMAGE_PIXELS = PILImage.MAX_IMAGE_PIXELS, None
+        try:
+            return PILImage.open(self.source)
+        finally:
+            PILImage.MAX_IMAGE_PIXELS = max_pixels
+
+
+    def _build_pyramid(self) -> None:
+        cache_dir = self.cache_dir
+        cache_dir.mkdir(parents=True, exist_ok=True)
+
+        source = self._open_source()
+        mode   = "RGBA" if "A" in source.getbands() or \
+                           "transparency" in source.info else "RGB"
+        pages  = self._get_tiff_pages(source)
+        values = self._get_value_range(source)
+
+        level = Level(cache_dir / "0.raw", *source.size, mode)
+        self._write_source_level(source, level, values)
+        sizes = [source.size]
+
+        while max(level.width, level.height) > self.min_level_size:
+            size = (math.ceil(level.width / 2), math.ceil(level.height / 2))
+
+            # Reduced-resolution pages of pyramidal TIFFs are used as is
+            if size in pages:
+                source.seek(pages[size])
+                level = Level(cache_dir / f"{len(sizes)}.raw", *size, mode)
+                self._write_source_level(source, level, values)
+            else:
+                level = self._build_level(level, len(sizes))
+
+            sizes.append((level.width, level.height))
+
+        # Written last, so that an interrupted build gets redone next time
+        (cache_dir / "meta.json").write_text(
+            json.dumps({"mode": mode, "levels": sizes})
+        )
+
+
+    @staticmethod
+    def _get_tiff_pages(source: PILImage.Image) -> Dict[Tuple[int, int], int]:
+        # {size: frame index} of the pages after the first
+        if source.format != "TIFF":
+            return {}
+
+        pages = {}
+        for frame in range(1, getattr(source, "n_frames", 1)):
+            source.seek(frame)
+            pages.setdefault(source.size, frame)
+
+        source.seek(0)
+        return pages
+
+
+    def _get_value_range(self, source: PILImage.Image
+                        ) -> Optional[Tuple[float, float]]:
+        # Lowest and highest values of images with more than 8 bits per
+        # channel, e.g. 16-bit microscopy, to stretch them to 8 bits.
+        if source.mode not in ("I", "F") and not source.mode.startswith("I;16"):
+            return None
+
+        low, high = math.inf, -math.inf
+
+        for band in self._iter_source_bands(source):
+            band_low, band_high = band.getextrema()
+            low, high           = min(low, band_low), max(high, band_high)
+
+        return (low, high)
+
+
+    def _write_source_level(self,
+                            source: PILImage.Image,
+                            level:  Level,
+                            values: Optional[Tuple[float, float]] = None
+                           ) -> None:
+
+        with open(level.path, "wb") as file:
+            for band in self._iter_source_bands(source):
+                if values:
+                    band = self._to_8_bits(band, *values)
+
+                file.write(band.convert(level.mode).tobytes())
+
+
+    @staticmethod
+    def _to_8_bits(band: PILImage.Image, low: float, high: float
+                  ) -> PILImage.Image:
+        scale = 255 / (high - low) if high > low else 1
+        band  = band if band.mode in ("I", "F") else band.convert("I")
+        return band.point(lambda v: v * scale - low * scale).convert("L")
+
+
+    def _build_level(self, previous: Level, index: int) -> Level:
+        level = Level(
+            previous.path.with_name(f"{index}.raw"),
+            math.ceil(previous.width / 2),
+            math.ceil(previous.height / 2),
+            previous.mode,
+        )
+
+        with open(level.path, "wb") as file:
+            for y in range(0, previous.height, self.band_height * 2):
+                band = previous.read(0, y, previous.width, self.band_height * 2)
+                file.write(band.reduce(2).tobytes())
+
+        return level
+
+
+    def _iter_source_bands(self, source: PILImage.Image):
+        # Decode only a few tiles/strips at a time when the format allows it,
+        # e.g. tiled or striped TIFFs and uncompressed formats.
+        # Otherwise, the whole image has to be decoded once.
+        try:
+            tiles = [t for tile in source.tile for t in self._split_tile(tile)]
+            bands = self._group_tiles(tiles)
+        except (TypeError, ValueError):
+            bands = []
+
+        if len(bands) < 2:
+            # Compressed TIFFs go through libtiff as a single tile
+            bands = self._group_tiles(self._get_tiff_pieces(source))
+
+            if len(bands) > 1:
+                with open(self.source, "rb") as file:
+                    for box, pieces in bands:
+                        yield self._decode_tiff_pieces(source, file, box,
+                                                       pieces)
+                return
+
+            source.load()
+            for y in range(0, source.height, self.band_height):
+                yield source.crop((0, y, source.width,
+                                   min(source.height, y + self.band_height)))
+            return
+
+        for box, band_tiles in bands:
+            yield self._decode_tiles(box, band_tiles, source.tell())
+
+
+    def _split_tile(self, tile: Tile) -> List[Tile]:
+        name, (x0, y0, x1, y1), offset, args = tile
+        args = (args,) if isinstance(args, str) else tuple(args)
+
+        rawmode, stride, orientation = (args + (0, 1))[:3]
+        bytes_per_px                 = data.RAW_MODE_BYTES.get(rawmode)
+
+        if name != "raw" or orientation != 1 or not bytes_per_px:
+            return [tile]
+
+        stride = stride or (x1 - x0) * bytes_per_px
+
+        return [
+            (name, (x0, y, x1, min(y1, y + self.band_height)),
+             offset + (y - y0) * stride, (rawmode, stride, 1))
+            for y in range(y0, y1, self.band_height)
+        ]
+
+
+    def _group_tiles(self, tiles: List[Tile]) -> List[Tuple[Box, List[Tile]]]:
+        rows = {}
+        for tile in sorted(tiles, key=lambda t: (t[1][1], t[1][0])):
+            rows.setdefault(tile[1][1], []).append(tile)
+
+        bands = []
+        for row_tiles in rows.values():
+            box = (min(t[1][0] for t in row_tiles),
+                   min(t[1][1] for t in row_tiles),
+                   max(t[1][2] for t in row_tiles),
+                   max(t[1][3] for t in row_tiles))
+
+            if bands and bands[-1][0][3] - bands[-1][0][1] < self.band_height:
+                prev_box, prev_tiles = bands[-1]
+                bands[-1] = ((min(prev_box[0], box[0]), prev_box[1],
+                              max(prev_box[2], box[2]), box[3]),
+                             prev_tiles + row_tiles)
+            else:
+                bands.append((box, row_tiles))
+
+        return bands
+
+
+    def _decode_tiles(self, box: Box, tiles: List[Tile], frame: int = 0
+                     ) -> PILImage.Image:
+        x0, y0, x1, y1 = box
+
+        part = self._open_source()
+        part.seek(frame)
+        part._size = (x1 - x0, y1 - y0)
+        part.tile  = [
+            _make_tile(name, (tx0 - x0, ty0 - y0, tx1 - x0, ty1 - y0),
+                       offset, args)
+            for name, (tx0, ty0, tx1, ty1), offset, args in tiles
+        ]
+        part.load()
+
+        # Pillow may have memory-mapped more than the part, get a plain copy
+        return part.crop((0, 0, *part.size))
+
+
+    def _get_tiff_pieces(self, source: PILImage.Image) -> List[Tile]:
+        # ("tiff", box, file offset, byte count) of each compressed strip or
+        # tile of the current TIFF page, which can be decoded separately.
+        if source.format != "TIFF" or source.tag_v2.get(284, 1) != 1:
+            return []  # 2: planar configuration, one strip per channel
+
+        tags = source.tag_v2
+
+        width, height = source.size
+
+        def values(tag: int) -> tuple:
+            value = tags[tag]
+            return value if isinstance(value, tuple) else (value,)
+
+        if 322 in tags:  # tiled, edge tiles are padded to the full tile size
+            tile_w, tile_h  = tags[322], tags[323]
+            offsets, counts = values(324), values(325)
+            per_row         = math.ceil(width / tile_w)
+            boxes           = [
+                (i % per_row * tile_w, i // per_row * tile_h,
+                 (i % per_row + 1) * tile_w, (i // per_row + 1) * tile_h)
+                for i in range(len(offsets))
+            ]
+        else:
+            rows            = min(height, tags.get(278, height))
+            offsets, counts = values(273), values(279)
+            boxes           = [
+                (0, y, width, min(height, y + rows))
+                for y in range(0, height, rows)
+            ]
+
+        if len(boxes) != len(offsets) or len(offsets) != len(counts):
+            return []
+
+        return [("tiff", *piece) for piece in zip(boxes, offsets, counts)]
+
+
+    def _decode_tiff_pieces(self,
+                            source: PILImage.Image,
+                            file:   io.BufferedReader,
+                            box:    Box,
+                            pieces: List[Tile]) -> PILImage.Image:
+
+        x0, y0 = box[:2]
+        x1, y1 = min(box[2], source.width), min(box[3], source.height)
+        band   = PILImage.new(source.mode, (x1 - x0, y1 - y0))
+
+        for _, (px0, py0, px1, py1), offset, count in pieces:
+            file.seek(offset)
+            piece = self._decode_tiff_piece(source, file.read(count),
+                                            px1 - px0, py1 - py0)
+            band.paste(piece, (px0 - x0, py0 - y0))
+
+        return band
+
+
+    @staticmethod
+    def _decode_tiff_piece(source: PILImage.Image,
+                           chunk:  bytes,
+                           width:  int,
+                           height: int) -> PILImage.Image:
+
+        # Wrap the compressed strip/tile in a TIFF of its own for libtiff:
+        # header, directory describing the strip, then the strip.
+        endian = source.tag_v2._endian
+        header = b"II*\0" if endian == "<" else b"MM\0*"
+        ifd    = TiffImagePlugin.ImageFileDirectory_v2(header + bytes(4))
+
+        for tag in data.TIFF_DECODING_TAGS:
+            if tag in source.tag_v2:
+                ifd.tagtype[tag] = source.tag_v2.tagtype[tag]
+                ifd[tag]         = source.tag_v2[tag]
+
+        # Pillow makes the strip offset relative to the directory's end
+        for tag, value in ((256, width), (257, height), (278, height),
+                           (273, 0), (279, len(chunk))):
+            ifd.tagtype[tag] = TiffTags.LONG
+            ifd[tag]         = value
+
+        piece = PILImage.open(io.BytesIO(
+            header + struct.pack(endian + "L", 8) + ifd.tobytes(8) + chunk
+        ))
+        piece.load()
+        return piece
+
+
+    def fit_zoom(self, view_w: int, view_h: int) -> float:
+        width, height = self.size
+        return min(1, view_w / width, view_h / height)
+
+
+    def region(self,
+               x:        int,
+               y:        int,
+               w:        int,
+               h:        int,
+               zoom:     float = 1,
+               resample: str   = "lanczos") -> PILImage.Image:
+
+        levels = self.load_pyramid()
+
+        # Use the smallest level that still has at least the needed resolution
+        index = max(0, min(len(levels) - 1, int(math.log2(1 / zoom))))
+        scale = 2 ** index
+
+        region = levels[index].read(
+            x // scale, y // scale, math.ceil(w / scale), math.ceil(h / scale)
+        )
+
+        out_size = (max(1, round(w * zoom)), max(1, round(h * zoom)))
+
+        if region.size == out_size:
+            return region
+
+        return region.resize(out_size, getattr(PILImage, resample.upper()))
+
+
+    def show(self,
+             zoom:     float = 0,
+             pan_x:    int   = 0,
+             pan_y:    int   = 0,
+             crop_w:   int   = 0,
+             crop_h:   int   = 0,
+             resample: str   = "lanczos",
+             **show_params) -> Image:
+
+        view_w = Image._negative_col_to_px(crop_w) or TERM.px_width
+        view_h = Image._negative_row_to_px(crop_h) or \
+                 TERM.px_height - TERM.cell_px_height
+
+        width, height = self.size
+        zoom          = zoom or self.fit_zoom(view_w, view_h)
+
+        pan_x = max(0, min(pan_x, width - 1))
+        pan_y = max(0, min(pan_y, height - 1))
+        src_w = min(width - pan_x, math.ceil(view_w / zoom))
+        src_h = min(height - pan_y, math.ceil(view_h / zoom))
+
+        pil_image = self.region(pan_x, pan_y, src_w, src_h, zoom, resample)
+        return Image(pil_image).show(**show_params)
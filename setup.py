@@ -30,9 +30,14 @@ setup(
         "blessed",
         "dataclasses;python_version<'3.7'",
         "docopt",
-        "pillow",
+        "pillow>=7.0",
         "requests"
     ],
+    extras_require = {
+        "fallback":  ["numpy"],
+        "turbojpeg": ["PyTurboJPEG"],
+        "vips":      ["pyvips"],
+    },
 
     include_package_data = True,
     packages             = find_packages(),